@@ -1,4 +1,11 @@
-from fastapi import FastAPI, HTTPException
+import os
+import asyncio
+from contextlib import asynccontextmanager
+import json
+import time
+from datetime import datetime
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse, Response
 from pydantic import BaseModel
 from typing import List
 import grpc
@@ -10,8 +17,123 @@ import main_pb2
 import main_pb2_grpc
 from typing import Optional
 import uvicorn
+from grpc_clients import GrpcClients
+import metrics
+import logs
+from concurrency_limit import CONCURRENCY_LIMIT_ENABLED, GradientLimit
+from auth import AUTHORIZATION_HEADER, InvalidToken, TokenVerifier
+from response_cache import RESPONSE_CACHE_ORDER_TTL, RESPONSE_CACHE_USER_TTL, ResponseCache, etag_matches
 
-app = FastAPI(title="Microservices API Gateway")
+logger = logs.setup_logging(os.getenv('SERVICE_NAME', 'API_GATEWAY'))
+
+GET_USERS_MAX_IDS = int(os.getenv('GET_USERS_MAX_IDS', '1000'))
+OVERLOAD_RETRY_AFTER = os.getenv('OVERLOAD_RETRY_AFTER', '1')
+# without it, callers with no token may still pass user_id in the body
+AUTH_REQUIRED = os.getenv('AUTH_REQUIRED', 'false').lower() == 'true'
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+READINESS_TIMEOUT = float(os.getenv('READINESS_TIMEOUT', '1'))
+# probes and scrapes must keep answering while the gateway sheds load
+UNLIMITED_PATHS = frozenset(("/metrics", "/healthz", "/readyz"))
+
+async def warm_up(clients):
+    started = time.perf_counter()
+    await clients.warm_up()
+    logger.info("Connected to all backends in %.3fs", time.perf_counter() - started)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.clients = GrpcClients()
+    # connect the channel pools now rather than on the first requests; /readyz waits for it
+    app.state.warm_up = asyncio.create_task(warm_up(app.state.clients))
+    yield
+    app.state.warm_up.cancel()
+    await app.state.clients.close()
+
+app = FastAPI(title="Microservices API Gateway", lifespan=lifespan)
+
+HTTP_LATENCY = metrics.REGISTRY.histogram(
+    'http_server_request_seconds', 'Gateway HTTP request latency.', ('method', 'route'))
+HTTP_RESPONSES = metrics.REGISTRY.counter(
+    'http_server_responses_total', 'Gateway HTTP responses by status.', ('method', 'route', 'status'))
+HTTP_LIMIT = metrics.REGISTRY.gauge('http_server_concurrency_limit', 'Current adaptive limit on gateway requests.')
+HTTP_LIMIT_REJECTED = metrics.REGISTRY.counter(
+    'http_server_limit_rejected_total', 'Gateway requests rejected with 503 by the concurrency limit.')
+
+tokens = TokenVerifier()
+TOKEN_CACHE_HITS = metrics.REGISTRY.counter('token_cache_hits_total', 'Tokens found already verified.')
+TOKEN_CACHE_MISSES = metrics.REGISTRY.counter('token_cache_misses_total', 'Tokens verified from scratch.')
+
+def collect_token_stats():
+    stats = tokens.stats()
+    TOKEN_CACHE_HITS.labels().set(stats['hits'])
+    TOKEN_CACHE_MISSES.labels().set(stats['misses'])
+
+metrics.REGISTRY.add_collector(collect_token_stats)
+
+responses = ResponseCache()
+RESPONSE_CACHE_HITS = metrics.REGISTRY.counter('response_cache_hits_total', 'Reads served from the response cache.')
+RESPONSE_CACHE_MISSES = metrics.REGISTRY.counter('response_cache_misses_total', 'Reads that called a backend.')
+RESPONSE_CACHE_BYTES = metrics.REGISTRY.gauge('response_cache_bytes', 'Bytes of cached response bodies.')
+NOT_MODIFIED = metrics.REGISTRY.counter('http_not_modified_total', 'Conditional reads answered with 304.', ('route',))
+
+def collect_response_cache_stats():
+    stats = responses.stats()
+    RESPONSE_CACHE_HITS.labels().set(stats['hits'] + stats['coalesced'])
+    RESPONSE_CACHE_MISSES.labels().set(stats['misses'])
+    RESPONSE_CACHE_BYTES.labels().set(stats['bytes'])
+
+metrics.REGISTRY.add_collector(collect_response_cache_stats)
+
+@app.middleware("http")
+async def authenticate(request: Request, call_next):
+    request.state.claims = None
+    header = request.headers.get(AUTHORIZATION_HEADER)
+    if header:
+        try:
+            request.state.claims = tokens.verify_header(header)
+        except InvalidToken as e:
+            return JSONResponse({"detail": f"Invalid token: {e}"}, status_code=401,
+                                headers={"WWW-Authenticate": "Bearer"})
+    return await call_next(request)
+
+# backend limits only see calls once they are dispatched; here the latency includes every queue downstream
+http_limit = GradientLimit(gauge=HTTP_LIMIT.labels())
+http_rejected = HTTP_LIMIT_REJECTED.labels()
+
+@app.middleware("http")
+async def shed_load(request: Request, call_next):
+    if not CONCURRENCY_LIMIT_ENABLED or request.url.path in UNLIMITED_PATHS:
+        return await call_next(request)
+    if not http_limit.try_acquire():
+        http_rejected.inc()
+        return JSONResponse({"detail": "Service overloaded, retry later"}, status_code=503,
+                            headers={"Retry-After": OVERLOAD_RETRY_AFTER})
+    started = time.perf_counter()
+    latency = None
+    try:
+        response = await call_next(request)
+        if response.status_code < 500:
+            latency = time.perf_counter() - started
+        return response
+    finally:
+        http_limit.release(latency)
+
+@app.middleware("http")
+async def record_metrics(request: Request, call_next):
+    request_id = request.headers.get(logs.REQUEST_ID_HEADER) or logs.new_request_id()
+    logs.request_id_var.set(request_id)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers[logs.REQUEST_ID_HEADER] = request_id
+        return response
+    finally:
+        route = request.scope.get("route")
+        path = route.path if route else "unmatched"
+        HTTP_LATENCY.labels(request.method, path).observe(time.perf_counter() - started)
+        HTTP_RESPONSES.labels(request.method, path, str(status)).inc()
 
 class UserCreate(BaseModel):
     username: str
@@ -28,31 +150,77 @@ class OrderItem(BaseModel):
     price: float
 
 class CreateOrder(BaseModel):
-    user_id: str
+    user_id: Optional[str] = None
     items: List[OrderItem]
 
+def order_to_dict(order):
+    return {
+        "order_id": order.order_id,
+        "user_id": order.user_id,
+        "status": order.status,
+        "items": [
+            {
+                "product_id": item.product_id,
+                "quantity": item.quantity,
+                "price": item.price
+            } for item in order.items
+        ],
+        "total_amount": order.total_amount,
+        "created_at": order.created_at
+    }
+
+def rpc_error(e, status_code, detail=None):
+    # backends shed load with RESOURCE_EXHAUSTED; tell clients to back off instead of failing hard
+    if e.code() == grpc.StatusCode.RESOURCE_EXHAUSTED:
+        return HTTPException(status_code=503, detail="Service overloaded, retry later",
+                             headers={"Retry-After": OVERLOAD_RETRY_AFTER})
+    return HTTPException(status_code=status_code, detail=detail if detail is not None else str(e))
+
+async def cached_read(route, key, load, ttl, if_none_match):
+    # clients may keep the body but must revalidate; a fresh entry answers that without a backend call
+    body, etag = await responses.get(key, load, ttl)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, etag):
+        NOT_MODIFIED.labels(route).inc()
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
 def get_user_client():
-    channel = grpc.insecure_channel('user_service:50051')
-    return user_pb2_grpc.UserServiceStub(channel)
+    return app.state.clients.user.stub()
 
 def get_order_client():
-    channel = grpc.insecure_channel('order_service:50052')
-    return order_pb2_grpc.OrderServiceStub(channel)
+    return app.state.clients.order.stub()
 
 def get_main_client():
-    channel = grpc.insecure_channel('main_service:50050')
-    return main_pb2_grpc.MainServiceStub(channel)
+    return app.state.clients.main.stub()
 
 
 @app.get("/")
 async def read_root():
     return {"message": "Welcome to the Microservices API"}
 
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/healthz", include_in_schema=False)
+async def healthz():
+    return {"status": "ok"}
+
+@app.get("/readyz", include_in_schema=False)
+async def readyz():
+    if not app.state.warm_up.done():
+        return JSONResponse({"status": "warming_up"}, status_code=503)
+    backends = await app.state.clients.health(READINESS_TIMEOUT)
+    ready = all(status == "SERVING" for status in backends.values())
+    return JSONResponse({"status": "ready" if ready else "not_ready", "backends": backends},
+                        status_code=200 if ready else 503)
+
 @app.post("/users")
 async def create_user(user: UserCreate):
     try:
         client = get_user_client()
-        response = client.CreateUser(
+        response = await client.CreateUser(
             user_pb2.CreateUserRequest(
                 username=user.username,
                 email=user.email,
@@ -65,13 +233,13 @@ async def create_user(user: UserCreate):
             "email": response.email
         }
     except grpc.RpcError as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise rpc_error(e, 500)
 
 @app.post("/users/login")
 async def login_user(user: UserLogin):
     try:
         client = get_user_client()
-        response = client.AuthenticateUser(
+        response = await client.AuthenticateUser(
             user_pb2.AuthRequest(
                 username=user.username,
                 password=user.password
@@ -79,23 +247,89 @@ async def login_user(user: UserLogin):
         )
         return {"token": response.token}
     except grpc.RpcError as e:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
+        raise rpc_error(e, 401, "Invalid credentials")
 
-@app.get("/users/{user_id}")
-async def get_user(user_id: str):
+@app.get("/users")
+async def get_users(ids: str):
+    user_ids = [user_id for user_id in ids.split(",") if user_id]
     try:
         client = get_user_client()
-        response = client.GetUser(user_pb2.GetUserRequest(user_id=user_id))
+        request = user_pb2.GetUsersRequest(user_ids=user_ids)
+        if len(user_ids) > GET_USERS_MAX_IDS:
+            users = [user async for user in client.StreamUsers(request)]
+        else:
+            users = (await client.GetUsers(request)).users
         return {
-            "user_id": response.user_id,
-            "username": response.username,
-            "email": response.email
+            "users": [
+                {
+                    "user_id": user.user_id,
+                    "username": user.username,
+                    "email": user.email
+                } for user in users
+            ]
         }
     except grpc.RpcError as e:
-        raise HTTPException(status_code=404, detail="User not found")
+        raise rpc_error(e, 500)
+
+@app.get("/users/{user_id}")
+async def get_user(user_id: str, if_none_match: Optional[str] = Header(default=None)):
+    async def load():
+        try:
+            client = get_user_client()
+            response = await client.GetUser(user_pb2.GetUserRequest(user_id=user_id))
+            return {
+                "user_id": response.user_id,
+                "username": response.username,
+                "email": response.email
+            }
+        except grpc.RpcError as e:
+            raise rpc_error(e, 404, "User not found")
+
+    return await cached_read("/users/{user_id}", ("user", user_id), load, RESPONSE_CACHE_USER_TTL, if_none_match)
+
+@app.get("/users/{user_id}/orders")
+async def list_user_orders(user_id: str, status: Optional[str] = None,
+                           page_size: int = 20, cursor: Optional[str] = None):
+    try:
+        client = get_order_client()
+        response = await client.ListOrders(
+            order_pb2.ListOrdersRequest(
+                user_id=user_id,
+                status=status or "",
+                page_size=page_size,
+                cursor=cursor or ""
+            )
+        )
+        return {
+            "orders": [order_to_dict(order) for order in response.orders],
+            "next_cursor": response.next_cursor or None
+        }
+    except grpc.RpcError as e:
+        if e.code() == grpc.StatusCode.INVALID_ARGUMENT:
+            raise HTTPException(status_code=400, detail=e.details())
+        raise rpc_error(e, 500)
 
 @app.post("/orders")
-async def create_order(order: CreateOrder):
+async def create_order(order: CreateOrder, request: Request,
+                       idempotency_key: Optional[str] = Header(default=None)):
+    if idempotency_key is not None and not 0 < len(idempotency_key) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise HTTPException(status_code=400, detail="Invalid Idempotency-Key")
+    claims = request.state.claims
+    metadata = None
+    if claims is not None:
+        if order.user_id and order.user_id != claims["user_id"]:
+            raise HTTPException(status_code=403, detail="Cannot create orders for another user")
+        user_id = claims["user_id"]
+        # lets MainService skip its user lookup
+        metadata = ((AUTHORIZATION_HEADER, request.headers[AUTHORIZATION_HEADER]),)
+    elif AUTH_REQUIRED:
+        raise HTTPException(status_code=401, detail="Authentication required",
+                            headers={"WWW-Authenticate": "Bearer"})
+    elif order.user_id:
+        user_id = order.user_id
+    else:
+        raise HTTPException(status_code=400, detail="user_id is required without a token")
+
     try:
         client = get_main_client()
         items = [
@@ -106,43 +340,84 @@ async def create_order(order: CreateOrder):
             ) for item in order.items
         ]
         
-        response = client.ProcessOrder(
+        response = await client.ProcessOrder(
             main_pb2.ProcessOrderRequest(
-                user_id=order.user_id,
-                items=items
-            )
+                user_id=user_id,
+                items=items,
+                idempotency_key=idempotency_key or ""
+            ),
+            metadata=metadata
         )
         
-        return {
+        result = {
             "order_id": response.order_id,
             "status": response.status,
             "message": response.message
         }
+        # accepted for background processing; poll GET /orders/{order_id} with the ticket
+        if response.status == "ACCEPTED":
+            return JSONResponse(result, status_code=202)
+        return result
     except grpc.RpcError as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        if e.code() == grpc.StatusCode.INVALID_ARGUMENT:
+            raise HTTPException(status_code=422, detail=e.details())
+        raise rpc_error(e, 500)
 
-@app.get("/orders/{order_id}")
-async def get_order(order_id: str):
-    try:
-        client = get_main_client()
-        response = client.GetOrderStatus(
-            main_pb2.GetOrderStatusRequest(order_id=order_id)
+@app.get("/orders/export")
+async def export_orders(from_date: Optional[str] = None, to_date: Optional[str] = None,
+                        status: Optional[str] = None):
+    # the response status is sent before the backend sees the request, so bad dates are caught here
+    for name, value in (("from_date", from_date), ("to_date", to_date)):
+        if value:
+            try:
+                datetime.fromisoformat(value)
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"{name} must be an ISO date")
+    call = get_order_client().ExportOrders(
+        order_pb2.ExportOrdersRequest(
+            from_date=from_date or "",
+            to_date=to_date or "",
+            status=status or ""
         )
-        return {
-            "order_id": response.order_id,
-            "status": response.status,
-            "items": [
-                {
-                    "product_id": item.product_id,
-                    "quantity": item.quantity,
-                    "price": item.price
-                } for item in response.items
-            ],
-            "total_amount": response.total_amount,
-            "created_at": response.created_at
-        }
-    except grpc.RpcError as e:
-        raise HTTPException(status_code=404, detail="Order not found")
+    )
+
+    async def ndjson():
+        try:
+            async for order in call:
+                yield json.dumps(order_to_dict(order)) + "\n"
+        except grpc.RpcError as e:
+            yield json.dumps({"error": e.details() or str(e.code())}) + "\n"
+        finally:
+            # stops the backend cursor when the HTTP client goes away
+            call.cancel()
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+@app.get("/orders/{order_id}")
+async def get_order(order_id: str, if_none_match: Optional[str] = Header(default=None)):
+    async def load():
+        try:
+            client = get_main_client()
+            response = await client.GetOrderStatus(
+                main_pb2.GetOrderStatusRequest(order_id=order_id)
+            )
+            return {
+                "order_id": response.order_id,
+                "status": response.status,
+                "items": [
+                    {
+                        "product_id": item.product_id,
+                        "quantity": item.quantity,
+                        "price": item.price
+                    } for item in response.items
+                ],
+                "total_amount": response.total_amount,
+                "created_at": response.created_at
+            }
+        except grpc.RpcError as e:
+            raise rpc_error(e, 404, "Order not found")
+
+    return await cached_read("/orders/{order_id}", ("order", order_id), load, RESPONSE_CACHE_ORDER_TTL, if_none_match)
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8000, log_config=None)
\ No newline at end of file
@@ -0,0 +1,66 @@
+import os
+import time
+from collections import OrderedDict
+import jwt
+
+JWT_SECRET_KEY = os.getenv('JWT_SECRET_KEY', 'your-secret-key-keep-it-safe')
+JWT_ALGORITHM = 'HS256'
+AUTH_CACHE_SIZE = int(os.getenv('AUTH_CACHE_SIZE', '10000'))
+
+AUTHORIZATION_HEADER = 'authorization'
+
+
+class InvalidToken(Exception):
+    pass
+
+
+class TokenVerifier:
+    """Verifies HS256 tokens locally and remembers the ones that passed.
+
+    The LRU is keyed by the whole token rather than just its signature, so a
+    cached signature cannot be reused with different claims; expiry is
+    still checked on every hit.
+    """
+
+    def __init__(self, secret=JWT_SECRET_KEY, max_size=AUTH_CACHE_SIZE):
+        self.secret = secret
+        self.max_size = max_size
+        self._verified = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def verify(self, token):
+        claims = self._verified.get(token)
+        if claims is not None:
+            if claims['exp'] > time.time():
+                self._verified.move_to_end(token)
+                self.hits += 1
+                return claims
+            del self._verified[token]
+
+        self.misses += 1
+        try:
+            claims = jwt.decode(token, self.secret, algorithms=[JWT_ALGORITHM],
+                                options={'require': ['exp', 'iat']})
+        except jwt.PyJWTError as e:
+            raise InvalidToken(str(e))
+        if not claims.get('user_id'):
+            raise InvalidToken('Token has no user_id')
+
+        self._verified[token] = claims
+        if len(self._verified) > self.max_size:
+            self._verified.popitem(last=False)
+        return claims
+
+    def verify_header(self, value):
+        scheme, _, token = value.partition(' ')
+        if scheme.lower() != 'bearer' or not token.strip():
+            raise InvalidToken('Expected a Bearer token')
+        return self.verify(token.strip())
+
+    def stats(self):
+        return {
+            'size': len(self._verified),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -0,0 +1,144 @@
+import os
+import math
+import time
+import grpc
+
+import metrics
+
+CONCURRENCY_LIMIT_ENABLED = os.getenv('CONCURRENCY_LIMIT_ENABLED', 'true').lower() == 'true'
+CONCURRENCY_LIMIT_INITIAL = int(os.getenv('CONCURRENCY_LIMIT_INITIAL', '100'))
+CONCURRENCY_LIMIT_MIN = int(os.getenv('CONCURRENCY_LIMIT_MIN', '4'))
+CONCURRENCY_LIMIT_MAX = int(os.getenv('CONCURRENCY_LIMIT_MAX', '500'))
+# how far short-term latency may rise above the long-term average before the limit shrinks
+CONCURRENCY_LIMIT_TOLERANCE = float(os.getenv('CONCURRENCY_LIMIT_TOLERANCE', '2.0'))
+
+SERVICE_WIDE = '*'
+
+LIMIT = metrics.REGISTRY.gauge(
+    'grpc_server_concurrency_limit', 'Current adaptive concurrency limit ("*" is service wide).',
+    ('grpc_service', 'grpc_method'))
+REJECTED = metrics.REGISTRY.counter(
+    'grpc_server_limit_rejected_total', 'RPCs rejected with RESOURCE_EXHAUSTED by the concurrency limit.',
+    ('grpc_service', 'grpc_method'))
+
+
+class GradientLimit:
+    """Concurrency limit steered by the ratio of long-term to short-term latency.
+
+    While recent latency stays within `tolerance` of the long-term average
+    the limit grows by about sqrt(limit) per adjustment; once requests start
+    queueing, recent latency rises and the limit is scaled down by up to half.
+    The limit only grows while at least half of it is in use.
+    """
+
+    def __init__(self, initial=CONCURRENCY_LIMIT_INITIAL, min_limit=CONCURRENCY_LIMIT_MIN,
+                 max_limit=CONCURRENCY_LIMIT_MAX, tolerance=CONCURRENCY_LIMIT_TOLERANCE,
+                 smoothing=0.2, short_alpha=0.1, long_window=600, gauge=None):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.short_alpha = short_alpha
+        self.long_alpha = 2 / (long_window + 1)
+        self.in_flight = 0
+        self._short = None
+        self._long = None
+        self._gauge = gauge
+        if gauge is not None:
+            gauge.set(initial)
+
+    def try_acquire(self):
+        if self.in_flight >= int(self.limit):
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self, latency=None):
+        in_flight = self.in_flight
+        self.in_flight -= 1
+        if latency is not None:
+            self._update(latency, in_flight)
+
+    def _update(self, latency, in_flight):
+        if self._long is None:
+            self._short = self._long = latency
+            return
+        self._short += (latency - self._short) * self.short_alpha
+        self._long += (latency - self._long) * self.long_alpha
+        # recover quickly once an overload that inflated the long-term average is over
+        if self._long > 2 * self._short:
+            self._long *= 0.95
+        if in_flight < self.limit / 2:
+            return
+        gradient = max(0.5, min(1.0, self.tolerance * self._long / self._short))
+        target = self.limit * gradient + math.sqrt(self.limit)
+        limit = self.limit * (1 - self.smoothing) + target * self.smoothing
+        self.limit = max(self.min_limit, min(self.max_limit, limit))
+        if self._gauge is not None:
+            self._gauge.set(int(self.limit))
+
+
+class ConcurrencyLimitInterceptor(grpc.aio.ServerInterceptor):
+    """Rejects unary RPCs with RESOURCE_EXHAUSTED above an adaptive in-flight limit.
+
+    Each method has its own limit and the service as a whole has another;
+    a call needs room in both. Streaming RPCs are passed through, since their
+    duration says nothing about server load. Put it after
+    ServerMetricsInterceptor so rejections show up in the RPC metrics.
+    """
+
+    def __init__(self, enabled=CONCURRENCY_LIMIT_ENABLED, **limit_options):
+        self.enabled = enabled
+        self._limit_options = limit_options
+        self._service_limits = {}
+        self._handlers = {}
+
+    def _service_limit(self, service):
+        limit = self._service_limits.get(service)
+        if limit is None:
+            limit = self._service_limits[service] = GradientLimit(
+                gauge=LIMIT.labels(service, SERVICE_WIDE), **self._limit_options
+            )
+        return limit
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None or not self.enabled or not handler.unary_unary:
+            return handler
+        method = handler_call_details.method
+        cached = self._handlers.get(method)
+        if cached is None or cached[0] is not handler:
+            cached = self._handlers[method] = (handler, self._wrap(method, handler))
+        return cached[1]
+
+    def _wrap(self, full_method, handler):
+        _, service, method = full_method.split('/', 2)
+        service_limit = self._service_limit(service)
+        method_limit = GradientLimit(gauge=LIMIT.labels(service, method), **self._limit_options)
+        rejected = REJECTED.labels(service, method)
+        behavior = handler.unary_unary
+
+        async def limited(request, context):
+            if not method_limit.try_acquire():
+                rejected.inc()
+                await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, 'Server overloaded, retry later')
+            if not service_limit.try_acquire():
+                method_limit.release()
+                rejected.inc()
+                await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, 'Server overloaded, retry later')
+            started = time.perf_counter()
+            latency = None
+            try:
+                response = await behavior(request, context)
+                latency = time.perf_counter() - started
+                return response
+            finally:
+                # failed and cancelled calls say little about capacity, so they are not sampled
+                method_limit.release(latency)
+                service_limit.release(latency)
+
+        return grpc.unary_unary_rpc_method_handler(
+            limited, request_deserializer=handler.request_deserializer,
+            response_serializer=handler.response_serializer,
+        )
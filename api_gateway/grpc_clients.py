@@ -0,0 +1,123 @@
+import os
+import asyncio
+import itertools
+import grpc
+from grpc_health.v1 import health_pb2, health_pb2_grpc
+
+import user_pb2_grpc
+import order_pb2_grpc
+import main_pb2_grpc
+import metrics
+import logs
+
+USER_SERVICE_ADDR = os.getenv('USER_SERVICE_ADDR', 'user_service:50051')
+ORDER_SERVICE_ADDR = os.getenv('ORDER_SERVICE_ADDR', 'order_service:50052')
+MAIN_SERVICE_ADDR = os.getenv('MAIN_SERVICE_ADDR', 'main_service:50050')
+
+GRPC_POOL_SIZE = int(os.getenv('GRPC_POOL_SIZE', '4'))
+GRPC_KEEPALIVE_TIME_MS = int(os.getenv('GRPC_KEEPALIVE_TIME_MS', '30000'))
+GRPC_KEEPALIVE_TIMEOUT_MS = int(os.getenv('GRPC_KEEPALIVE_TIMEOUT_MS', '10000'))
+GRPC_CHANNEL_MAX_IN_FLIGHT = int(os.getenv('GRPC_CHANNEL_MAX_IN_FLIGHT', '100'))
+
+
+def channel_options():
+    return [
+        ('grpc.keepalive_time_ms', GRPC_KEEPALIVE_TIME_MS),
+        ('grpc.keepalive_timeout_ms', GRPC_KEEPALIVE_TIMEOUT_MS),
+        # Without a local subchannel pool every channel to the same target
+        # shares one TCP connection, which defeats the pool.
+        ('grpc.use_local_subchannel_pool', 1),
+    ]
+
+
+class LimitedChannel:
+    """Channel wrapper that lets at most `limit` unary calls run at once; the rest wait here.
+
+    A server-side grpc.max_concurrent_streams would refuse the excess
+    streams with UNAVAILABLE instead of queueing them. Streaming calls are
+    passed through, like in ConcurrencyLimitInterceptor.
+    """
+
+    def __init__(self, channel, limit):
+        self._channel = channel
+        self._slots = asyncio.Semaphore(limit)
+        # calls running or waiting for a slot
+        self.in_flight = 0
+
+    def unary_unary(self, method, *args, **kwargs):
+        call = self._channel.unary_unary(method, *args, **kwargs)
+
+        async def limited(*call_args, **call_kwargs):
+            self.in_flight += 1
+            try:
+                async with self._slots:
+                    return await call(*call_args, **call_kwargs)
+            finally:
+                self.in_flight -= 1
+        return limited
+
+    def __getattr__(self, name):
+        return getattr(self._channel, name)
+
+
+class ChannelPool:
+    def __init__(self, target, stub_class, size=GRPC_POOL_SIZE, options=None,
+                 max_in_flight=GRPC_CHANNEL_MAX_IN_FLIGHT):
+        self.target = target
+        self._channels = [
+            grpc.aio.insecure_channel(target, options=options or channel_options())
+            for _ in range(max(1, size))
+        ]
+        self._limited = [
+            LimitedChannel(metrics.InstrumentedChannel(channel, metadata=logs.request_metadata), max_in_flight)
+            for channel in self._channels
+        ]
+        self._stubs = [stub_class(channel) for channel in self._limited]
+        self._offsets = itertools.cycle(range(len(self._stubs)))
+        self._health = health_pb2_grpc.HealthStub(self._channels[0])
+
+    def stub(self):
+        """Stub on the channel with the fewest calls in flight; ties rotate so idle traffic is spread too."""
+        start = next(self._offsets)
+        size = len(self._stubs)
+        index = min(range(size), key=lambda i: (self._limited[i].in_flight, (i - start) % size))
+        return self._stubs[index]
+
+    async def warm_up(self):
+        """Waits until every channel in the pool is connected."""
+        await asyncio.gather(*(channel.channel_ready() for channel in self._channels))
+
+    async def health(self, timeout):
+        """The backend's grpc.health.v1 status name, or the gRPC code if it could not be asked."""
+        try:
+            response = await self._health.Check(health_pb2.HealthCheckRequest(), timeout=timeout)
+        except grpc.RpcError as e:
+            return e.code().name
+        return health_pb2.HealthCheckResponse.ServingStatus.Name(response.status)
+
+    async def close(self):
+        for channel in self._channels:
+            await channel.close()
+
+
+class GrpcClients:
+    def __init__(self, pool_size=GRPC_POOL_SIZE):
+        self.user = ChannelPool(USER_SERVICE_ADDR, user_pb2_grpc.UserServiceStub, pool_size)
+        self.order = ChannelPool(ORDER_SERVICE_ADDR, order_pb2_grpc.OrderServiceStub, pool_size)
+        self.main = ChannelPool(MAIN_SERVICE_ADDR, main_pb2_grpc.MainServiceStub, pool_size)
+
+    def pools(self):
+        return {'user_service': self.user, 'order_service': self.order, 'main_service': self.main}
+
+    async def warm_up(self):
+        await asyncio.gather(*(pool.warm_up() for pool in self.pools().values()))
+
+    async def health(self, timeout):
+        names = list(self.pools())
+        statuses = await asyncio.gather(*(pool.health(timeout) for pool in self.pools().values()))
+        return dict(zip(names, statuses))
+
+    async def close(self):
+        await self.user.close()
+        await self.order.close()
+        await self.main.close()
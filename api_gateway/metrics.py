@@ -0,0 +1,537 @@
+import os
+import time
+import asyncio
+import logging
+from bisect import bisect_left
+import grpc
+
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = logging.getLogger(os.getenv('SERVICE_NAME', 'METRICS'))
+
+_CODE_NAMES = {code.value[0]: code.name for code in grpc.StatusCode}
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class _Value:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    type = 'counter'
+    _new_child = _Value
+
+    def _render_child(self, values, child):
+        yield f'{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}'
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+
+class _HistogramValue:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Timer:
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def _render_child(self, values, child):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), child.counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, values, [('le', _format_value(bound))])
+            yield f'{self.name}_bucket{labels} {cumulative}'
+        labels = _format_labels(self.labelnames, values)
+        yield f'{self.name}_sum{labels} {_format_value(child.sum)}'
+        yield f'{self.name}_count{labels} {child.count}'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collect):
+        """`collect()` is called before every scrape, e.g. to copy cache stats into gauges."""
+        self._collectors.append(collect)
+
+    def render(self):
+        for collect in self._collectors:
+            collect()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+SERVER_HANDLED = REGISTRY.counter(
+    'grpc_server_handled_total', 'RPCs completed on the server by status code.',
+    ('grpc_service', 'grpc_method', 'grpc_code'))
+SERVER_LATENCY = REGISTRY.histogram(
+    'grpc_server_handling_seconds', 'Server-side RPC latency.', ('grpc_service', 'grpc_method'))
+SERVER_IN_FLIGHT = REGISTRY.gauge(
+    'grpc_server_in_flight', 'RPCs currently being handled.', ('grpc_service', 'grpc_method'))
+
+CLIENT_HANDLED = REGISTRY.counter(
+    'grpc_client_handled_total', 'RPCs completed by this client by status code.',
+    ('grpc_service', 'grpc_method', 'grpc_code'))
+CLIENT_LATENCY = REGISTRY.histogram(
+    'grpc_client_handling_seconds', 'Client-side RPC latency.', ('grpc_service', 'grpc_method'))
+CLIENT_IN_FLIGHT = REGISTRY.gauge(
+    'grpc_client_in_flight', 'RPCs currently awaiting a response.', ('grpc_service', 'grpc_method'))
+
+MONGO_LATENCY = REGISTRY.histogram(
+    'mongo_operation_seconds', 'MongoDB operation latency.', ('collection', 'operation'))
+MONGO_ERRORS = REGISTRY.counter(
+    'mongo_operation_errors_total', 'MongoDB operations that raised.', ('collection', 'operation'))
+
+
+def code_name(code):
+    if code is None:
+        return 'OK'
+    if isinstance(code, grpc.StatusCode):
+        return code.name
+    return _CODE_NAMES.get(code, str(code))
+
+
+def _split_method(full_method):
+    _, service, method = full_method.split('/', 2)
+    return service, method
+
+
+class _MethodMetrics:
+    __slots__ = ('latency', 'in_flight', 'handled', 'service', 'method', '_codes')
+
+    def __init__(self, full_method, latency, in_flight, handled):
+        self.service, self.method = _split_method(full_method)
+        self.latency = latency.labels(self.service, self.method)
+        self.in_flight = in_flight.labels(self.service, self.method)
+        self.handled = handled
+        self._codes = {}
+
+    def done(self, started, code):
+        self.latency.observe(time.perf_counter() - started)
+        self.in_flight.dec()
+        counter = self._codes.get(code)
+        if counter is None:
+            counter = self._codes[code] = self.handled.labels(self.service, self.method, code)
+        counter.inc()
+
+
+class ServerMetricsInterceptor(grpc.aio.ServerInterceptor):
+    def __init__(self):
+        self._handlers = {}
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None:
+            return None
+        method = handler_call_details.method
+        cached = self._handlers.get(method)
+        # wrap each distinct handler once; later interceptors still run per call
+        if cached is None or cached[0] is not handler:
+            cached = self._handlers[method] = (handler, self._wrap(method, handler))
+        return cached[1]
+
+    def _wrap(self, method, handler):
+        stats = _MethodMetrics(method, SERVER_LATENCY, SERVER_IN_FLIGHT, SERVER_HANDLED)
+
+        if handler.unary_unary or handler.stream_unary:
+            behavior = handler.unary_unary or handler.stream_unary
+
+            async def unary_response(request, context):
+                stats.in_flight.inc()
+                started = time.perf_counter()
+                code = 'UNKNOWN'
+                try:
+                    response = await behavior(request, context)
+                    code = code_name(context.code())
+                    return response
+                except asyncio.CancelledError:
+                    code = 'CANCELLED'
+                    raise
+                except Exception:
+                    code = code_name(context.code()) if context.code() else 'UNKNOWN'
+                    raise
+                finally:
+                    stats.done(started, code)
+
+            factory = (grpc.unary_unary_rpc_method_handler if handler.unary_unary
+                       else grpc.stream_unary_rpc_method_handler)
+            return factory(unary_response, request_deserializer=handler.request_deserializer,
+                           response_serializer=handler.response_serializer)
+
+        behavior = handler.unary_stream or handler.stream_stream
+
+        async def stream_response(request, context):
+            stats.in_flight.inc()
+            started = time.perf_counter()
+            code = 'UNKNOWN'
+            try:
+                async for response in behavior(request, context):
+                    yield response
+                code = code_name(context.code())
+            except (asyncio.CancelledError, GeneratorExit):
+                code = 'CANCELLED'
+                raise
+            except Exception:
+                code = code_name(context.code()) if context.code() else 'UNKNOWN'
+                raise
+            finally:
+                stats.done(started, code)
+
+        factory = (grpc.unary_stream_rpc_method_handler if handler.unary_stream
+                   else grpc.stream_stream_rpc_method_handler)
+        return factory(stream_response, request_deserializer=handler.request_deserializer,
+                       response_serializer=handler.response_serializer)
+
+
+def _with_metadata(kwargs, provider):
+    extra = provider()
+    if extra:
+        kwargs['metadata'] = tuple(kwargs.get('metadata') or ()) + tuple(extra)
+    return kwargs
+
+
+class _UnaryUnaryCall:
+    __slots__ = ('_multicallable', '_stats', '_metadata')
+
+    def __init__(self, multicallable, stats, metadata):
+        self._multicallable = multicallable
+        self._stats = stats
+        self._metadata = metadata
+
+    async def __call__(self, request, **kwargs):
+        if self._metadata:
+            kwargs = _with_metadata(kwargs, self._metadata)
+        stats = self._stats
+        stats.in_flight.inc()
+        started = time.perf_counter()
+        code = 'UNKNOWN'
+        try:
+            response = await self._multicallable(request, **kwargs)
+            code = 'OK'
+            return response
+        except grpc.RpcError as e:
+            code = code_name(e.code())
+            raise
+        except asyncio.CancelledError:
+            code = 'CANCELLED'
+            raise
+        finally:
+            stats.done(started, code)
+
+
+class _StreamingCall:
+    __slots__ = ('_multicallable', '_stats', '_metadata', '_observers')
+
+    def __init__(self, multicallable, stats, metadata, observers):
+        self._multicallable = multicallable
+        self._stats = stats
+        self._metadata = metadata
+        self._observers = observers
+
+    def __call__(self, *args, **kwargs):
+        if self._metadata:
+            kwargs = _with_metadata(kwargs, self._metadata)
+        self._stats.in_flight.inc()
+        started = time.perf_counter()
+        call = self._multicallable(*args, **kwargs)
+        task = asyncio.ensure_future(self._observe(started, call))
+        self._observers.add(task)
+        task.add_done_callback(self._observers.discard)
+        return call
+
+    async def _observe(self, started, call):
+        try:
+            code = code_name(await call.code())
+        except asyncio.CancelledError:
+            code = 'CANCELLED'
+        self._stats.done(started, code)
+
+
+class InstrumentedChannel:
+    """grpc.aio channel wrapper recording client-side RPC metrics.
+
+    Stubs built on it get instrumented multicallables. This is much cheaper
+    than grpc.aio client interceptors, which add tens of microseconds per call.
+    `metadata`, if given, is called per RPC and its result appended to the
+    call's metadata (e.g. to propagate request ids).
+    """
+
+    def __init__(self, channel, metadata=None):
+        self._channel = channel
+        self._metadata = metadata
+        self._observers = set()
+
+    def _stats(self, method):
+        return _MethodMetrics(method, CLIENT_LATENCY, CLIENT_IN_FLIGHT, CLIENT_HANDLED)
+
+    def unary_unary(self, method, *args, **kwargs):
+        return _UnaryUnaryCall(self._channel.unary_unary(method, *args, **kwargs),
+                               self._stats(method), self._metadata)
+
+    def unary_stream(self, method, *args, **kwargs):
+        return _StreamingCall(self._channel.unary_stream(method, *args, **kwargs),
+                              self._stats(method), self._metadata, self._observers)
+
+    def stream_unary(self, method, *args, **kwargs):
+        return _StreamingCall(self._channel.stream_unary(method, *args, **kwargs),
+                              self._stats(method), self._metadata, self._observers)
+
+    def stream_stream(self, method, *args, **kwargs):
+        return _StreamingCall(self._channel.stream_stream(method, *args, **kwargs),
+                              self._stats(method), self._metadata, self._observers)
+
+    def __getattr__(self, name):
+        return getattr(self._channel, name)
+
+
+class InstrumentedCollection:
+    """Motor collection proxy that times every awaited operation and cursor read."""
+
+    TIMED = frozenset((
+        'insert_one', 'insert_many', 'find_one', 'find_one_and_update', 'update_one',
+        'update_many', 'delete_one', 'delete_many', 'bulk_write', 'count_documents',
+        'create_index', 'create_indexes', 'drop',
+    ))
+    CURSORS = frozenset(('find', 'aggregate'))
+
+    def __init__(self, collection):
+        self._collection = collection
+        self._wrapped = {}
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name not in self.TIMED and name not in self.CURSORS:
+            return attr
+        wrapped = self._wrapped.get(name)
+        if wrapped is None:
+            wrapped = self._wrapped[name] = self._timed(name) if name in self.TIMED else self._cursor(name)
+        return wrapped
+
+    def _timed(self, operation):
+        collection_name = self._collection.name
+        latency = MONGO_LATENCY.labels(collection_name, operation)
+        errors = MONGO_ERRORS.labels(collection_name, operation)
+
+        async def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await getattr(self._collection, operation)(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                latency.observe(time.perf_counter() - started)
+
+        return timed
+
+    def _cursor(self, operation):
+        collection_name = self._collection.name
+        latency = MONGO_LATENCY.labels(collection_name, operation)
+        errors = MONGO_ERRORS.labels(collection_name, operation)
+
+        def cursor(*args, **kwargs):
+            return InstrumentedCursor(getattr(self._collection, operation)(*args, **kwargs), latency, errors)
+
+        return cursor
+
+
+class InstrumentedCursor:
+    """Motor cursor proxy recording one sample per read.
+
+    `to_list` is timed as a whole. When the cursor is iterated, the time spent
+    waiting for documents is summed and recorded once the cursor is exhausted,
+    fails or is closed, so documents served from the fetched batch do not
+    flood the histogram with zero-latency samples.
+    """
+
+    def __init__(self, cursor, latency, errors):
+        self._cursor = cursor
+        self._latency = latency
+        self._errors = errors
+        self._iterator = None
+        self._waited = None
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if not callable(attr):
+            return attr
+
+        def chained(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            # sort(), limit(), batch_size() and the like return the cursor itself
+            return self if result is self._cursor else result
+
+        return chained
+
+    async def to_list(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await self._cursor.to_list(*args, **kwargs)
+        except Exception:
+            self._errors.inc()
+            raise
+        finally:
+            self._latency.observe(time.perf_counter() - started)
+
+    def __aiter__(self):
+        if self._iterator is None:
+            self._iterator = self._cursor.__aiter__()
+            self._waited = 0.0
+        return self
+
+    async def __anext__(self):
+        started = time.perf_counter()
+        try:
+            doc = await self._iterator.__anext__()
+        except StopAsyncIteration:
+            self._record(started)
+            raise
+        except Exception:
+            self._errors.inc()
+            self._record(started)
+            raise
+        self._waited += time.perf_counter() - started
+        return doc
+
+    def _record(self, started=None):
+        if self._waited is None:
+            return
+        if started is not None:
+            self._waited += time.perf_counter() - started
+        self._latency.observe(self._waited)
+        self._waited = None
+
+    async def close(self):
+        self._record()
+        await self._cursor.close()
+
+
+async def _handle_scrape(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        if request_line.split(b' ')[1:2] == [b'/metrics']:
+            status, body = '200 OK', REGISTRY.render().encode()
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write(
+            f'HTTP/1.1 {status}\r\n'
+            f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            f'Connection: close\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_http_server(port=METRICS_PORT):
+    """Serves GET /metrics in Prometheus text format; port 0 disables it."""
+    if not port:
+        return None
+    server = await asyncio.start_server(_handle_scrape, '0.0.0.0', port)
+    logger.info("Serving metrics on :%s/metrics", port)
+    return server
@@ -0,0 +1,105 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+RESPONSE_CACHE_ORDER_TTL = float(os.getenv('RESPONSE_CACHE_ORDER_TTL', '2'))
+RESPONSE_CACHE_USER_TTL = float(os.getenv('RESPONSE_CACHE_USER_TTL', '10'))
+
+
+def render(payload):
+    """JSON body the way FastAPI's JSONResponse renders it."""
+    return json.dumps(payload, ensure_ascii=False, allow_nan=False, indent=None,
+                      separators=(",", ":")).encode("utf-8")
+
+
+def etag_for(body):
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match, etag):
+    """Weak comparison, as If-None-Match requires: W/ prefixes are ignored and "*" matches anything."""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate.removeprefix('W/') == etag:
+            return True
+    return False
+
+
+class ResponseCache:
+    """Rendered JSON bodies and their ETags, keyed by (route, id).
+
+    Bounded by body size with LRU eviction; entries live for the TTL given
+    on each `get`, so a cached body is at most that stale. Only successful
+    loads are stored, and concurrent misses for the same key share one
+    backend call.
+    """
+
+    def __init__(self, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get(self, key, load, ttl):
+        """Returns (body, etag), calling `load()` for the payload dict only if `key` is not fresh."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, body, etag = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return body, etag
+            self._drop(key)
+
+        task = self._inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._load(key, load, ttl))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._inflight[key] = task
+        else:
+            self.coalesced += 1
+        # shield so a disconnecting client does not cancel the call the others wait on
+        return await asyncio.shield(task)
+
+    async def _load(self, key, load, ttl):
+        try:
+            body = render(await load())
+            etag = etag_for(body)
+            self._store(key, body, etag, ttl)
+            return body, etag
+        finally:
+            del self._inflight[key]
+
+    def _store(self, key, body, etag, ttl):
+        if ttl <= 0 or len(body) > self.max_bytes:
+            return
+        self._drop(key)
+        self._entries[key] = (time.monotonic() + ttl, body, etag)
+        self.size_bytes += len(body)
+        while self.size_bytes > self.max_bytes:
+            _, (_, evicted, _) = self._entries.popitem(last=False)
+            self.size_bytes -= len(evicted)
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size_bytes -= len(entry[1])
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'bytes': self.size_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+        }
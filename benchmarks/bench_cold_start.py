@@ -0,0 +1,102 @@
+"""Cold start of user_service/order_service: time to SERVING and latency of the first requests.
+
+Needs a reachable MongoDB (MONGODB_URI) and generated stubs next to the service:
+    cd user_service && python -m grpc_tools.protoc -I./protos --python_out=. --grpc_python_out=. ./protos/user.proto
+    MONGODB_URI=mongodb://localhost:27017 python benchmarks/bench_cold_start.py --service user
+
+Each run starts a fresh server process. With --no-wait the first request is
+sent as soon as the port answers, the way clients that ignore health checks
+hit a fresh process; otherwise the client waits for SERVING first.
+"""
+import os
+import sys
+import time
+import signal
+import asyncio
+import argparse
+import statistics
+import subprocess
+
+import grpc
+from grpc_health.v1 import health_pb2, health_pb2_grpc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SERVICES = {
+    'user': ('user_service', 50051),
+    'order': ('order_service', 50052),
+}
+
+
+def request_factory(service):
+    from bson import ObjectId
+    if service == 'user':
+        import user_pb2
+        import user_pb2_grpc
+        return user_pb2_grpc.UserServiceStub, lambda stub: stub.GetUser(
+            user_pb2.GetUserRequest(user_id=str(ObjectId())))
+    import order_pb2
+    import order_pb2_grpc
+    return order_pb2_grpc.OrderServiceStub, lambda stub: stub.GetOrder(
+        order_pb2.GetOrderRequest(order_id=str(ObjectId())))
+
+
+async def timed(call):
+    started = time.perf_counter()
+    try:
+        await call
+    except grpc.RpcError as e:
+        # a random id is NOT_FOUND, which still goes all the way to MongoDB
+        if e.code() != grpc.StatusCode.NOT_FOUND:
+            raise
+    return time.perf_counter() - started
+
+
+async def cold_start(args, stub_class, send):
+    directory, port = SERVICES[args.service]
+    env = dict(os.environ, METRICS_PORT='0', LOG_LEVEL='WARNING')
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, f'{directory}.py'], cwd=os.path.join(ROOT, directory), env=env)
+    result = {}
+    try:
+        async with grpc.aio.insecure_channel(f'127.0.0.1:{port}') as channel:
+            health = health_pb2_grpc.HealthStub(channel)
+            while True:
+                try:
+                    status = (await health.Check(health_pb2.HealthCheckRequest(), timeout=1)).status
+                except grpc.RpcError:
+                    await asyncio.sleep(0.005)
+                    continue
+                result.setdefault('listening_ms', (time.perf_counter() - started) * 1000)
+                if status == health_pb2.HealthCheckResponse.SERVING or args.no_wait:
+                    break
+                await asyncio.sleep(0.005)
+            result['ready_ms'] = (time.perf_counter() - started) * 1000
+
+            stub = stub_class(channel)
+            latencies = [await timed(send(stub)) for _ in range(args.requests)]
+            result['first_ms'] = latencies[0] * 1000
+            result['steady_p50_ms'] = statistics.median(latencies[1:]) * 1000
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--service', choices=sorted(SERVICES), default='user')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=21, help='requests per run, the first included')
+    parser.add_argument('--no-wait', action='store_true', help='do not wait for SERVING before the first request')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.join(ROOT, SERVICES[args.service][0]))
+    stub_class, send = request_factory(args.service)
+    runs = [asyncio.run(cold_start(args, stub_class, send)) for _ in range(args.runs)]
+    for key in runs[0]:
+        values = [run[key] for run in runs]
+        print({'metric': key, 'median': round(statistics.median(values), 2), 'max': round(max(values), 2)})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'user_service'))
+
+from hashing import HashingEngine, HashingBusy, _hash
+
+
+async def probe_loop_latency(stop, samples):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.01)
+        samples.append(time.perf_counter() - started - 0.01)
+
+
+async def login_storm(workers, logins, concurrency):
+    engine = HashingEngine(max_workers=workers, max_pending=concurrency)
+    hashed = _hash('password')
+    # warm the worker processes so spawn cost is not measured
+    await asyncio.gather(*(engine.verify('password', hashed) for _ in range(workers)))
+
+    stop = asyncio.Event()
+    lag = []
+    probe = asyncio.create_task(probe_loop_latency(stop, lag))
+    queue = asyncio.Queue()
+    for _ in range(logins):
+        queue.put_nowait(None)
+    rejected = 0
+
+    async def worker():
+        nonlocal rejected
+        while not queue.empty():
+            queue.get_nowait()
+            try:
+                await engine.verify('password', hashed)
+            except HashingBusy:
+                rejected += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe
+    engine.shutdown()
+
+    lag.sort()
+    return {
+        'workers': workers,
+        'logins_per_sec': round((logins - rejected) / elapsed, 1),
+        'rejected': rejected,
+        'loop_lag_p99_ms': round(lag[int(len(lag) * 0.99) - 1] * 1000, 2) if lag else 0.0,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='bcrypt login throughput vs hashing pool size')
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    workers = 1
+    while workers <= args.max_workers:
+        print(await login_storm(workers, args.logins, args.concurrency))
+        workers *= 2
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
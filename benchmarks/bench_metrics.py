@@ -0,0 +1,99 @@
+"""Per-call cost of the metrics layer.
+
+Measures a bare histogram observation, the server interceptor wrapper
+around an in-process handler, and a full loopback unary RPC with and
+without the server interceptor and the instrumented client channel.
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'order_service'))
+
+import grpc
+import metrics
+
+
+class FakeContext:
+    def code(self):
+        return None
+
+
+async def echo(request, context):
+    return request
+
+
+def handler():
+    return grpc.unary_unary_rpc_method_handler(echo)
+
+
+def micro(iterations):
+    histogram = metrics.REGISTRY.histogram('bench_seconds', 'bench').labels()
+    started = time.perf_counter()
+    for _ in range(iterations):
+        histogram.observe(0.003)
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+async def wrapper_overhead(iterations):
+    interceptor = metrics.ServerMetricsInterceptor()
+    wrapped = interceptor._wrap('/bench.Bench/Echo', handler()).unary_unary
+    context = FakeContext()
+
+    started = time.perf_counter()
+    for _ in range(iterations):
+        await echo(b'x', context)
+    raw = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(iterations):
+        await wrapped(b'x', context)
+    instrumented = time.perf_counter() - started
+    return (instrumented - raw) / iterations * 1e6
+
+
+async def rpc_latency(iterations, instrumented, port):
+    server = grpc.aio.server(interceptors=[metrics.ServerMetricsInterceptor()] if instrumented else None)
+    server.add_generic_rpc_handlers((grpc.method_handlers_generic_handler('bench.Bench', {'Echo': handler()}),))
+    server.add_insecure_port(f'127.0.0.1:{port}')
+    await server.start()
+    channel = grpc.aio.insecure_channel(f'127.0.0.1:{port}')
+    client = metrics.InstrumentedChannel(channel) if instrumented else channel
+    call = client.unary_unary('/bench.Bench/Echo')
+    for _ in range(200):
+        await call(b'x')
+    started = time.perf_counter()
+    for _ in range(iterations):
+        await call(b'x')
+    elapsed = time.perf_counter() - started
+    await channel.close()
+    await server.stop(None)
+    return elapsed / iterations * 1e6
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=100000)
+    parser.add_argument('--rpcs', type=int, default=2000)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--port', type=int, default=56999)
+    args = parser.parse_args()
+
+    print({'histogram_observe_us': round(micro(args.iterations), 3)})
+    print({'server_wrapper_overhead_us': round(await wrapper_overhead(args.iterations), 3)})
+    # alternate the two setups and keep medians, loopback RPC timings are noisy
+    plain, instrumented = [], []
+    for _ in range(args.rounds):
+        plain.append(await rpc_latency(args.rpcs, False, args.port))
+        instrumented.append(await rpc_latency(args.rpcs, True, args.port))
+    plain = statistics.median(plain)
+    instrumented = statistics.median(instrumented)
+    print({'rpc_us_plain': round(plain, 1), 'rpc_us_instrumented': round(instrumented, 1),
+           'rpc_overhead_us': round(instrumented - plain, 1)})
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,112 @@
+"""Document size and read throughput of legacy vs. compact order documents.
+
+Needs a reachable MongoDB (MONGODB_URI) and generated order_pb2 modules:
+    cd order_service && python -m grpc_tools.protoc -I./protos --python_out=. --grpc_python_out=. ./protos/order.proto
+    MONGODB_URI=mongodb://localhost:27017 python benchmarks/bench_order_schema.py
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+from datetime import datetime, timedelta
+
+import bson
+
+os.environ.setdefault('MONGODB_DB', 'orderdb_bench')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'order_service'))
+
+import order_service
+from pymongo import ASCENDING
+from order_schema import CREATED_AT, ORDER_PROJECTION, compact_order, order_response
+
+
+def legacy_orders(count, days):
+    started = datetime(2024, 1, 1)
+    for _ in range(count):
+        items = [{
+            'product_id': str(random.randint(1, 5000)),
+            'quantity': random.randint(1, 5),
+            'price': random.randint(99, 99999) / 100
+        } for _ in range(random.randint(1, 5))]
+        yield {
+            '_id': bson.ObjectId(),
+            'user_id': str(bson.ObjectId()),
+            'items': items,
+            'status': 'PENDING',
+            'total_amount': sum(item['price'] * item['quantity'] for item in items),
+            'created_at': (started + timedelta(seconds=random.uniform(0, days * 86400))).isoformat()
+        }
+
+
+async def point_reads(collection, ids, projection, concurrency):
+    remaining = list(ids)
+
+    async def worker():
+        while remaining:
+            order = await collection.find_one({'_id': remaining.pop()}, projection)
+            order_response(order)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return len(ids) / (time.perf_counter() - started)
+
+
+async def range_read(collection, field, start, end, projection):
+    started = time.perf_counter()
+    count = 0
+    async for order in collection.find({field: {'$gte': start, '$lt': end}}, projection).sort(field, ASCENDING):
+        order_response(order)
+        count += 1
+    return count / (time.perf_counter() - started)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--orders', type=int, default=50000)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--reads', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    args = parser.parse_args()
+
+    legacy = order_service.db.orders_legacy_bench
+    compact = order_service.db.orders_compact_bench
+    await legacy.drop()
+    await compact.drop()
+
+    docs = list(legacy_orders(args.orders, args.days))
+    await legacy.insert_many(docs)
+    await compact.insert_many([compact_order(doc) for doc in docs])
+    await legacy.create_index([('created_at', ASCENDING)])
+    await compact.create_index([(CREATED_AT, ASCENDING)])
+
+    ids = [doc['_id'] for doc in random.sample(docs, min(args.reads, len(docs)))]
+    day_start = datetime(2024, 1, 1) + timedelta(days=args.days // 2)
+    day_end = day_start + timedelta(days=1)
+
+    results = {}
+    for name, collection, field, projection, start, end in (
+        ('legacy', legacy, 'created_at', None, day_start.isoformat(), day_end.isoformat()),
+        ('compact', compact, CREATED_AT, ORDER_PROJECTION, day_start, day_end),
+    ):
+        sizes = [len(bson.encode(doc if name == 'legacy' else compact_order(doc))) for doc in docs[:1000]]
+        results[name] = {
+            'avg_doc_bytes': round(sum(sizes) / len(sizes), 1),
+            'point_reads_per_sec': round(await point_reads(collection, ids, projection, args.concurrency), 1),
+            'range_docs_per_sec': round(await range_read(collection, field, start, end, projection), 1),
+        }
+        print({'schema': name, **results[name]})
+
+    print({
+        'size_ratio': round(results['compact']['avg_doc_bytes'] / results['legacy']['avg_doc_bytes'], 2),
+        'point_read_speedup': round(results['compact']['point_reads_per_sec'] / results['legacy']['point_reads_per_sec'], 2),
+        'range_read_speedup': round(results['compact']['range_docs_per_sec'] / results['legacy']['range_docs_per_sec'], 2),
+    })
+    await legacy.drop()
+    await compact.drop()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,67 @@
+"""Orders/sec for per-call insert_one vs. the coalesced insert_many path.
+
+Needs a reachable MongoDB (MONGODB_URI) and generated order_pb2 modules:
+    cd order_service && python -m grpc_tools.protoc -I./protos --python_out=. --grpc_python_out=. ./protos/order.proto
+    MONGODB_URI=mongodb://localhost:27017 python benchmarks/bench_order_writes.py
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+os.environ.setdefault('MONGODB_DB', 'orderdb_bench')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'order_service'))
+
+import order_service
+from order_pb2 import CreateOrderRequest, OrderItem
+
+
+class BenchContext:
+    def set_code(self, code):
+        raise RuntimeError(f"RPC failed with {code}")
+
+    def set_details(self, details):
+        pass
+
+
+async def run(servicer, orders, concurrency):
+    request = CreateOrderRequest(
+        user_id='bench-user',
+        items=[OrderItem(product_id='1', quantity=2, price=9.99)]
+    )
+    context = BenchContext()
+    remaining = orders
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            await servicer.CreateOrder(request, context)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return orders / (time.perf_counter() - started)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--orders', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=256)
+    args = parser.parse_args()
+
+    await order_service.orders_collection.drop()
+    per_call = await run(order_service.OrderService(coalesce_writes=False), args.orders, args.concurrency)
+    print({'path': 'insert_one', 'orders_per_sec': round(per_call, 1)})
+
+    servicer = order_service.OrderService(coalesce_writes=True)
+    coalesced = await run(servicer, args.orders, args.concurrency)
+    await servicer.coalescer.close()
+    print({'path': 'coalesced insert_many', 'orders_per_sec': round(coalesced, 1),
+           'speedup': round(coalesced / per_call, 2)})
+    await order_service.orders_collection.drop()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,134 @@
+"""GetUser and AuthenticateUser throughput of user_service as SERVER_WORKERS goes from 1 to N.
+
+Needs a reachable MongoDB (MONGODB_URI) and generated stubs next to the service:
+    cd user_service && python -m grpc_tools.protoc -I./protos --python_out=. --grpc_python_out=. ./protos/user.proto
+    MONGODB_URI=mongodb://localhost:27017 python benchmarks/bench_workers.py --max-workers 4
+
+The load generator runs in --clients processes on the same machine, so the
+speedup is bounded by the cores left over for the server. AuthenticateUser
+goes through each worker's bcrypt pool (HASH_WORKERS processes per worker).
+"""
+import os
+import sys
+import time
+import signal
+import asyncio
+import argparse
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+SERVICE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'user_service')
+sys.path.insert(0, SERVICE_DIR)
+
+import grpc
+import user_pb2
+import user_pb2_grpc
+
+TARGET = '127.0.0.1:50051'
+PASSWORD = 'bench'
+
+
+def make_request(method, user):
+    if method == 'GetUser':
+        return user_pb2.GetUserRequest(user_id=user['user_id'])
+    return user_pb2.AuthRequest(username=user['username'], password=PASSWORD)
+
+
+async def drive(method, user, duration, connections, concurrency):
+    # separate subchannel pools give every channel its own connection, which the kernel
+    # hands to one of the workers
+    channels = [
+        grpc.aio.insecure_channel(TARGET, options=[('grpc.use_local_subchannel_pool', 1)])
+        for _ in range(connections)
+    ]
+    request = make_request(method, user)
+    deadline = time.perf_counter() + duration
+    completed = rejected = 0
+
+    async def worker(stub):
+        nonlocal completed, rejected
+        call = getattr(stub, method)
+        while time.perf_counter() < deadline:
+            try:
+                response = await call(request)
+            except grpc.RpcError as e:
+                # the bcrypt pool and concurrency limit shed excess load; count it, it is part of the result
+                if e.code() != grpc.StatusCode.RESOURCE_EXHAUSTED:
+                    raise
+                rejected += 1
+                await asyncio.sleep(0.01)
+                continue
+            if method == 'AuthenticateUser' and not response.success:
+                raise RuntimeError(f"AuthenticateUser failed: {response.error}")
+            completed += 1
+
+    stubs = [user_pb2_grpc.UserServiceStub(channel) for channel in channels]
+    await asyncio.gather(*(worker(stubs[index % len(stubs)]) for index in range(concurrency)))
+    for channel in channels:
+        await channel.close()
+    return completed, rejected
+
+
+def client(args):
+    return asyncio.run(drive(*args))
+
+
+async def wait_ready(timeout=30):
+    async with grpc.aio.insecure_channel(TARGET) as channel:
+        await asyncio.wait_for(channel.channel_ready(), timeout)
+
+
+async def create_user():
+    username = f'bench-{time.time_ns()}'
+    async with grpc.aio.insecure_channel(TARGET) as channel:
+        response = await user_pb2_grpc.UserServiceStub(channel).CreateUser(user_pb2.CreateUserRequest(
+            username=username, email='bench@example.com', password=PASSWORD
+        ))
+        return {'user_id': response.user_id, 'username': username}
+
+
+def measure(workers, args, pool):
+    env = dict(os.environ, SERVER_WORKERS=str(workers), METRICS_PORT='0', LOG_LEVEL='ERROR')
+    env.setdefault('MONGODB_DB', 'userdb_bench')
+    server = subprocess.Popen([sys.executable, 'user_service.py'], cwd=SERVICE_DIR, env=env)
+    try:
+        asyncio.run(wait_ready())
+        # the first worker to listen answers the probe; give the rest a moment
+        time.sleep(1)
+        user = asyncio.run(create_user())
+        results = {}
+        for method in args.methods:
+            job = (method, user, args.duration, args.connections, args.concurrency)
+            counts = list(pool.map(client, [job] * args.clients))
+            results[method] = (sum(completed for completed, _ in counts) / args.duration,
+                               sum(rejected for _, rejected in counts))
+        return results
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--clients', type=int, default=4, help='load generator processes')
+    parser.add_argument('--connections', type=int, default=4, help='connections per client')
+    parser.add_argument('--concurrency', type=int, default=32, help='in-flight calls per client')
+    parser.add_argument('--methods', nargs='+', choices=('GetUser', 'AuthenticateUser'),
+                        default=['GetUser', 'AuthenticateUser'])
+    args = parser.parse_args()
+
+    counts = sorted({1, *(2 ** power for power in range(1, args.max_workers.bit_length())), args.max_workers})
+    baseline = {}
+    with ProcessPoolExecutor(args.clients, mp_context=multiprocessing.get_context('spawn')) as pool:
+        for workers in counts:
+            for method, (rps, rejected) in measure(workers, args, pool).items():
+                baseline.setdefault(method, rps)
+                print({'method': method, 'workers': workers, 'cpus': os.cpu_count(), 'rps': round(rps, 1),
+                       'rejected': rejected, 'speedup': round(rps / baseline[method], 2)})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""Boots the whole stack in one process on local ports.
+
+UserService, OrderService and MainService run on grpc.aio servers and the
+gateway runs under uvicorn, all on the current event loop. Unless a real
+MongoDB URI is given, Motor is replaced by mongomock-motor before the
+services are imported, so nothing outside the process is needed.
+"""
+import os
+import sys
+import asyncio
+import tempfile
+import importlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROTOS = {
+    'user.proto': 'user_service',
+    'order.proto': 'order_service',
+    'main.proto': 'main_service',
+}
+
+
+def generate_stubs(out_dir):
+    from grpc_tools import protoc
+    for proto, service in PROTOS.items():
+        proto_dir = os.path.join(ROOT, service, 'protos')
+        result = protoc.main([
+            'grpc_tools.protoc',
+            f'-I{proto_dir}',
+            f'--python_out={out_dir}',
+            f'--grpc_python_out={out_dir}',
+            os.path.join(proto_dir, proto),
+        ])
+        if result != 0:
+            raise RuntimeError(f"protoc failed for {proto}")
+
+
+class Stack:
+    def __init__(self, base_port=56050, mongodb_uri=None, env=None):
+        self.base_port = base_port
+        self.mongodb_uri = mongodb_uri
+        self.env = env or {}
+        self.user_addr = f'127.0.0.1:{base_port + 1}'
+        self.order_addr = f'127.0.0.1:{base_port + 2}'
+        self.main_addr = f'127.0.0.1:{base_port}'
+        self.gateway_url = f'http://127.0.0.1:{base_port + 3}'
+        self._stubs_dir = None
+        self._servers = []
+        self._readiness = []
+        self._tasks = []
+        self._uvicorn = None
+        self._uvicorn_task = None
+        self._hashing = None
+
+    def _prepare_imports(self):
+        os.environ.setdefault('LOG_LEVEL', 'WARNING')
+        os.environ['USER_SERVICE_ADDR'] = self.user_addr
+        os.environ['ORDER_SERVICE_ADDR'] = self.order_addr
+        os.environ['MAIN_SERVICE_ADDR'] = self.main_addr
+        os.environ['MONGODB_DB'] = os.environ.get('MONGODB_DB', 'bench')
+        if self.mongodb_uri:
+            os.environ['MONGODB_URI'] = self.mongodb_uri
+        os.environ.update(self.env)
+
+        if not self.mongodb_uri:
+            import motor.motor_asyncio
+            import mongomock_motor
+            motor.motor_asyncio.AsyncIOMotorClient = mongomock_motor.AsyncMongoMockClient
+
+        self._stubs_dir = tempfile.TemporaryDirectory(prefix='bench_stubs_')
+        generate_stubs(self._stubs_dir.name)
+        sys.path.insert(0, self._stubs_dir.name)
+        for service in ('user_service', 'order_service', 'main_service', 'api_gateway'):
+            sys.path.insert(0, os.path.join(ROOT, service))
+
+    async def _grpc_server(self, add_servicer, servicer, addr, warm_up_steps):
+        import grpc
+        import metrics
+        import logs
+        from concurrency_limit import ConcurrencyLimitInterceptor
+        from readiness import Readiness
+        server = grpc.aio.server(interceptors=[
+            logs.RequestIdInterceptor(),
+            metrics.ServerMetricsInterceptor(),
+            ConcurrencyLimitInterceptor(),
+        ])
+        add_servicer(servicer, server)
+        readiness = Readiness(server)
+        await readiness.start(warm_up_steps)
+        server.add_insecure_port(addr)
+        await server.start()
+        self._servers.append(server)
+        self._readiness.append(readiness)
+        return server
+
+    async def start(self):
+        self._prepare_imports()
+        import uvicorn
+        import user_pb2_grpc
+        import order_pb2_grpc
+        import main_pb2_grpc
+        user_service = importlib.import_module('user_service')
+        order_service = importlib.import_module('order_service')
+        main_service = importlib.import_module('main_service')
+        api_gateway = importlib.import_module('api_gateway')
+
+        self._hashing = user_service.HashingEngine()
+        self.user_service = user_service.UserService(self._hashing)
+        await self._grpc_server(user_pb2_grpc.add_UserServiceServicer_to_server,
+                                self.user_service, self.user_addr, user_service.warm_up_steps())
+
+        self.order_service = order_service.OrderService()
+        await self._grpc_server(order_pb2_grpc.add_OrderServiceServicer_to_server,
+                                self.order_service, self.order_addr, order_service.warm_up_steps())
+
+        self.main_service = main_service.MainService()
+        await self._grpc_server(main_pb2_grpc.add_MainServiceServicer_to_server,
+                                self.main_service, self.main_addr, self.main_service.warm_up_steps())
+        self._tasks.append(asyncio.create_task(
+            self.main_service.order_cache.watch(self.main_service.watch_order_changes)
+        ))
+        if self.main_service.outbox is not None:
+            self._tasks.append(asyncio.create_task(self.main_service.outbox.run()))
+        while not all(readiness.ready for readiness in self._readiness):
+            await asyncio.sleep(0.01)
+
+        config = uvicorn.Config(api_gateway.app, host='127.0.0.1', port=self.base_port + 3,
+                                log_level='warning', lifespan='on', access_log=False)
+        self._uvicorn = uvicorn.Server(config)
+        self._uvicorn_task = asyncio.create_task(self._uvicorn.serve())
+        while not self._uvicorn.started:
+            await asyncio.sleep(0.05)
+        await api_gateway.app.state.warm_up
+        return self
+
+    async def stop(self):
+        if self._uvicorn_task:
+            self._uvicorn.should_exit = True
+            await self._uvicorn_task
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for readiness in self._readiness:
+            await readiness.stop()
+        for server in self._servers:
+            await server.stop(grace=1)
+        self._servers.clear()
+        self._readiness.clear()
+        if self._hashing:
+            self._hashing.shutdown()
+        if self._stubs_dir:
+            self._stubs_dir.cleanup()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.stop()
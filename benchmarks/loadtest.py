@@ -0,0 +1,265 @@
+"""Replayable load test of the gateway against an in-process stack.
+
+Closed loop: --concurrency clients issue requests back to back.
+Open loop: requests arrive as a Poisson process at --rate per second,
+whether or not earlier ones have finished, so queueing shows up in latency.
+
+    python benchmarks/loadtest.py --mode closed --concurrency 32 --duration 30
+    python benchmarks/loadtest.py --mode open --rate 200 --duration 30 --output run.json
+
+The report is JSON with per-endpoint throughput, error counts, p50/p95/p99
+and a latency histogram, so runs from two commits can be diffed directly.
+A fixed --seed makes the request sequence reproducible.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import bisect
+import itertools
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import httpx
+from harness import Stack
+
+DEFAULT_MIX = 'create_user=1,login=1,create_order=4,poll_status=10'
+
+HISTOGRAM_BOUNDS_MS = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+# httpx scans its whole pool on every request, so large pools are split across clients
+CONNECTIONS_PER_CLIENT = 50
+
+
+class EndpointStats:
+    def __init__(self):
+        self.latencies = []
+        self.errors = {}
+
+    def record(self, latency, status):
+        self.latencies.append(latency)
+        if status >= 400:
+            self.errors[str(status)] = self.errors.get(str(status), 0) + 1
+
+    def report(self, elapsed):
+        latencies = sorted(self.latencies)
+        buckets = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+        for latency in latencies:
+            buckets[bisect.bisect_left(HISTOGRAM_BOUNDS_MS, latency * 1000)] += 1
+        errors = sum(self.errors.values())
+        return {
+            'requests': len(latencies),
+            'errors': self.errors,
+            'throughput_rps': round(len(latencies) / elapsed, 2),
+            'goodput_rps': round((len(latencies) - errors) / elapsed, 2),
+            'p50_ms': percentile(latencies, 0.50),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99),
+            'max_ms': round(latencies[-1] * 1000, 3) if latencies else None,
+            'histogram_ms': {
+                **{f'le_{bound}': count for bound, count in zip(HISTOGRAM_BOUNDS_MS, buckets)},
+                'inf': buckets[-1],
+            },
+        }
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values))) - 1))
+    return round(sorted_values[index] * 1000, 3)
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        name, weight = part.split('=')
+        if name not in Workload.OPERATIONS:
+            raise SystemExit(f"Unknown operation in mix: {name}")
+        weights[name] = float(weight)
+    return weights
+
+
+class Workload:
+    OPERATIONS = ('create_user', 'login', 'create_order', 'poll_status')
+
+    def __init__(self, clients, mix, seed):
+        self.clients = itertools.cycle(clients)
+        self.rng = random.Random(seed)
+        self.names = list(mix)
+        self.weights = [mix[name] for name in self.names]
+        self.users = []
+        self.orders = []
+        self.stats = {name: EndpointStats() for name in self.OPERATIONS}
+        self._user_seq = 0
+
+    def _new_credentials(self):
+        self._user_seq += 1
+        name = f'bench{self._user_seq}'
+        return {'username': name, 'email': f'{name}@bench.local', 'password': 'bench-password'}
+
+    async def seed(self, users, orders_per_user):
+        for _ in range(users):
+            await self.create_user(record=False)
+        for user in list(self.users):
+            for _ in range(orders_per_user):
+                await self.create_order(user, record=False)
+
+    async def _call(self, name, method, url, record=True, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await next(self.clients).request(method, url, **kwargs)
+            status = response.status_code
+        except httpx.HTTPError:
+            response, status = None, 599
+        if record:
+            self.stats[name].record(time.perf_counter() - started, status)
+        return response if status < 400 else None
+
+    async def create_user(self, record=True):
+        credentials = self._new_credentials()
+        response = await self._call('create_user', 'POST', '/users', record, json=credentials)
+        if response is not None:
+            self.users.append({**credentials, 'user_id': response.json()['user_id']})
+
+    async def login(self):
+        if not self.users:
+            return await self.create_user()
+        user = self.rng.choice(self.users)
+        await self._call('login', 'POST', '/users/login',
+                         json={'username': user['username'], 'password': user['password']})
+
+    async def create_order(self, user=None, record=True):
+        if user is None:
+            if not self.users:
+                return await self.create_user()
+            user = self.rng.choice(self.users)
+        items = [
+            {'product_id': str(self.rng.randint(1, 1000)), 'quantity': self.rng.randint(1, 5),
+             'price': round(self.rng.uniform(1, 100), 2)}
+            for _ in range(self.rng.randint(1, 4))
+        ]
+        response = await self._call('create_order', 'POST', '/orders', record,
+                                    json={'user_id': user['user_id'], 'items': items})
+        if response is not None:
+            self.orders.append(response.json()['order_id'])
+
+    async def poll_status(self):
+        if not self.orders:
+            return await self.create_order()
+        order_id = self.rng.choice(self.orders)
+        await self._call('poll_status', 'GET', f'/orders/{order_id}')
+
+    def next_operation(self):
+        return getattr(self, self.rng.choices(self.names, self.weights)[0])
+
+    async def closed_loop(self, concurrency, duration):
+        deadline = time.perf_counter() + duration
+
+        async def client_loop():
+            while time.perf_counter() < deadline:
+                await self.next_operation()()
+
+        await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+
+    async def open_loop(self, rate, duration, max_outstanding):
+        deadline = time.perf_counter() + duration
+        outstanding = set()
+        dropped = 0
+        next_arrival = time.perf_counter()
+        while next_arrival < deadline:
+            delay = next_arrival - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if len(outstanding) >= max_outstanding:
+                dropped += 1
+            else:
+                task = asyncio.create_task(self.next_operation()())
+                outstanding.add(task)
+                task.add_done_callback(outstanding.discard)
+            next_arrival += self.rng.expovariate(rate)
+        if outstanding:
+            await asyncio.gather(*outstanding, return_exceptions=True)
+        return dropped
+
+
+async def run(args):
+    mix = parse_mix(args.mix)
+    async with Stack(base_port=args.base_port, mongodb_uri=args.mongodb_uri) as stack:
+        connections = args.max_connections
+        if args.mode == 'open':
+            # arrivals queued inside the HTTP client would hide server-side queueing
+            connections = max(connections, args.max_outstanding)
+        client_count = -(-connections // CONNECTIONS_PER_CLIENT)
+        per_client = -(-connections // client_count)
+        limits = httpx.Limits(max_connections=per_client, max_keepalive_connections=per_client)
+        async with contextlib.AsyncExitStack() as clients:
+            workload = Workload([
+                await clients.enter_async_context(
+                    httpx.AsyncClient(base_url=stack.gateway_url, limits=limits, timeout=args.timeout)
+                )
+                for _ in range(client_count)
+            ], mix, args.seed)
+            await workload.seed(args.seed_users, args.seed_orders)
+
+            started = time.perf_counter()
+            dropped = 0
+            if args.mode == 'closed':
+                await workload.closed_loop(args.concurrency, args.duration)
+            else:
+                dropped = await workload.open_loop(args.rate, args.duration, args.max_outstanding)
+            elapsed = time.perf_counter() - started
+
+    total = EndpointStats()
+    for stats in workload.stats.values():
+        total.latencies.extend(stats.latencies)
+        for status, count in stats.errors.items():
+            total.errors[status] = total.errors.get(status, 0) + count
+
+    return {
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'elapsed_s': round(elapsed, 3),
+        'dropped_arrivals': dropped,
+        'total': total.report(elapsed),
+        'endpoints': {
+            name: stats.report(elapsed)
+            for name, stats in workload.stats.items() if stats.latencies
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Gateway load test against an in-process stack')
+    parser.add_argument('--mode', choices=('closed', 'open'), default='closed')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--concurrency', type=int, default=16, help='closed loop clients')
+    parser.add_argument('--rate', type=float, default=100, help='open loop arrivals per second')
+    parser.add_argument('--max-outstanding', type=int, default=1000,
+                        help='open loop arrivals beyond this many in flight are dropped and counted')
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--seed-users', type=int, default=20)
+    parser.add_argument('--seed-orders', type=int, default=5, help='orders per seeded user')
+    parser.add_argument('--max-connections', type=int, default=100,
+                        help='HTTP connections; the open loop uses at least --max-outstanding')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--base-port', type=int, default=56050)
+    parser.add_argument('--mongodb-uri', default=None,
+                        help='use a real MongoDB instead of the in-memory stand-in')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    report = json.dumps(asyncio.run(run(args)), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import os
+import time
+import asyncio
+from collections import OrderedDict
+
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', '10000'))
+IDEMPOTENCY_CACHE_TTL = float(os.getenv('IDEMPOTENCY_CACHE_TTL', '300'))
+
+
+class IdempotencyCache:
+    """In-memory fast path for keyed ProcessOrder calls.
+
+    Retries of a request this process has already handled get the original
+    response without any backend call, and concurrent duplicates share one
+    in-flight attempt. Only successful responses are kept; OrderService's
+    dedup store stays authoritative across processes and restarts.
+    """
+
+    def __init__(self, max_size=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_CACHE_TTL):
+        self._entries = OrderedDict()
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key, fingerprint, create):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic() and entry[1] == fingerprint:
+            response = await asyncio.shield(entry[2])
+            if response.order_id:
+                self.hits += 1
+                return response
+        # a different request under a reused key goes through, so OrderService can reject it
+
+        self.misses += 1
+        task = asyncio.ensure_future(create())
+        self._entries[key] = (time.monotonic() + self.ttl, fingerprint, task)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        # shielded so a retry can pick up the attempt even if this caller gives up
+        response = await asyncio.shield(task)
+        if not response.order_id:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is task:
+                del self._entries[key]
+        return response
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -1,9 +1,9 @@
 import os
 import asyncio
-import logging
+import functools
 from concurrent import futures
 import grpc
-from termcolor import colored
+import motor.motor_asyncio
 
 import main_pb2
 import main_pb2_grpc
@@ -11,33 +11,249 @@ import order_pb2
 import order_pb2_grpc
 import user_pb2
 import user_pb2_grpc
+from user_cache import UserCache
+from order_cache import OrderCache
+from resilience import OutboundCalls, bind_deadline
+from auth import AUTHORIZATION_HEADER, InvalidToken, TokenVerifier
+from idempotency_cache import IdempotencyCache
+from order_outbox import (
+    OrderOutbox, OutboxFull, Rejected, ACCEPTED, DONE, REJECTED, FAILED, ticket_id, is_ticket, parse_ticket
+)
+import metrics
+from concurrency_limit import ConcurrencyLimitInterceptor
+import logs
+import supervisor
+from readiness import Readiness, ping_mongodb
+
+logger = logs.setup_logging(os.getenv('SERVICE_NAME', 'MAIN_SERVICE'))
+
+USER_SERVICE_ADDR = os.getenv('USER_SERVICE_ADDR', 'user_service:50051')
+ORDER_SERVICE_ADDR = os.getenv('ORDER_SERVICE_ADDR', 'order_service:50052')
+MONGODB_URI = os.getenv('MONGODB_URI', 'mongodb://localhost:27017')
+MONGODB_DB = os.getenv('MONGODB_DB', 'maindb')
+# accept orders into the outbox and create them in the background
+ASYNC_ORDER_ACCEPTANCE = os.getenv('ASYNC_ORDER_ACCEPTANCE', 'false').lower() == 'true'
+
+client = motor.motor_asyncio.AsyncIOMotorClient(MONGODB_URI)
+db = client[MONGODB_DB]
+
+CACHE_HITS = metrics.REGISTRY.counter('cache_hits_total', 'Cache hits.', ('cache',))
+CACHE_MISSES = metrics.REGISTRY.counter('cache_misses_total', 'Cache misses.', ('cache',))
+CACHE_ENTRIES = metrics.REGISTRY.gauge('cache_entries', 'Entries currently cached.', ('cache',))
+OUTBOX_PENDING = metrics.REGISTRY.gauge('order_outbox_pending', 'Accepted orders not yet created.')
+OUTBOX_COMPLETED = metrics.REGISTRY.counter('order_outbox_completed_total', 'Accepted orders created.')
+OUTBOX_FAILED = metrics.REGISTRY.counter(
+    'order_outbox_failed_total', 'Accepted orders rejected or given up on.')
+
+def validate_order(request):
+    if not request.user_id:
+        return 'user_id is required'
+    if not request.items:
+        return 'Order has no items'
+    for item in request.items:
+        if item.quantity <= 0:
+            return 'Item quantity must be positive'
+        if item.price < 0:
+            return 'Item price must not be negative'
+    return None
 
-logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'))
-logger = logging.getLogger(os.getenv('SERVICE_NAME', 'MAIN_SERVICE'))
 
 class MainService(main_pb2_grpc.MainServiceServicer):
-    def __init__(self):
-        self.user_channel = grpc.aio.insecure_channel('user_service:50051')
+    def __init__(self, async_acceptance=ASYNC_ORDER_ACCEPTANCE):
+        self.user_channel = metrics.InstrumentedChannel(
+            grpc.aio.insecure_channel(USER_SERVICE_ADDR), metadata=logs.request_metadata
+        )
         self.user_stub = user_pb2_grpc.UserServiceStub(self.user_channel)
+        self.user_calls = OutboundCalls('user_service', self.user_stub)
         
-        self.order_channel = grpc.aio.insecure_channel('order_service:50052')
+        self.order_channel = metrics.InstrumentedChannel(
+            grpc.aio.insecure_channel(ORDER_SERVICE_ADDR), metadata=logs.request_metadata
+        )
         self.order_stub = order_pb2_grpc.OrderServiceStub(self.order_channel)
+        self.order_calls = OutboundCalls('order_service', self.order_stub)
+
+        self.tokens = TokenVerifier()
+        self.user_cache = UserCache(self._fetch_user)
+        self.order_cache = OrderCache(self._fetch_order_status)
+        self.recent_orders = IdempotencyCache()
+        self.outbox = None
+        if async_acceptance:
+            self.outbox = OrderOutbox(
+                metrics.InstrumentedCollection(db.order_outbox), self._create_accepted_orders
+            )
+        metrics.REGISTRY.add_collector(self._collect_cache_stats)
+
+    def warm_up_steps(self):
+        # connect both downstream channels up front instead of on the first order
+        steps = [('user_service', self.user_channel.channel_ready),
+                 ('order_service', self.order_channel.channel_ready)]
+        if self.outbox is not None:
+            steps += [('mongodb', functools.partial(ping_mongodb, client)),
+                      ('outbox_indexes', self.outbox.ensure_indexes)]
+        return steps
+
+    def _collect_cache_stats(self):
+        for name, cache in (('user', self.user_cache), ('order', self.order_cache), ('token', self.tokens),
+                            ('idempotency', self.recent_orders)):
+            stats = cache.stats()
+            CACHE_HITS.labels(name).set(stats['hits'])
+            CACHE_MISSES.labels(name).set(stats['misses'])
+            CACHE_ENTRIES.labels(name).set(stats['size'])
+        if self.outbox is not None:
+            stats = self.outbox.stats()
+            OUTBOX_PENDING.labels().set(stats['pending'])
+            OUTBOX_COMPLETED.labels().set(stats['completed'])
+            OUTBOX_FAILED.labels().set(stats['failed'])
+
+    def _token_user_id(self, context):
+        for key, value in context.invocation_metadata() or ():
+            if key == AUTHORIZATION_HEADER:
+                try:
+                    return self.tokens.verify_header(value)['user_id']
+                except InvalidToken:
+                    return None
+        return None
+
+    def watch_order_changes(self):
+        return self.order_stub.WatchOrderChanges(order_pb2.WatchOrderChangesRequest())
+
+    async def _fetch_order_status(self, order_id):
+        try:
+            order_response = await self.order_calls.read(
+                'GetOrder', order_pb2.GetOrderRequest(order_id=order_id)
+            )
+        except grpc.RpcError as e:
+            if e.code() == grpc.StatusCode.NOT_FOUND:
+                return None
+            raise
+        if not order_response or not order_response.order_id:
+            return None
+        
+        items = [
+            main_pb2.OrderItem(
+                product_id=item.product_id,
+                quantity=item.quantity,
+                price=item.price
+            ) for item in order_response.items
+        ]
+        
+        return main_pb2.GetOrderStatusResponse(
+            order_id=order_response.order_id,
+            status=order_response.status,
+            items=items,
+            total_amount=order_response.total_amount,
+            created_at=order_response.created_at
+        )
+
+    async def _fetch_user(self, user_id):
+        try:
+            user_response = await self.user_calls.read(
+                'GetUser', user_pb2.GetUserRequest(user_id=user_id)
+            )
+        except grpc.RpcError as e:
+            if e.code() == grpc.StatusCode.NOT_FOUND:
+                return None
+            raise
+        if not user_response or not user_response.user_id:
+            return None
+        return user_response
 
     async def ProcessOrder(self, request, context):
+        bind_deadline(context)
+        if request.idempotency_key:
+            return await self.recent_orders.get(
+                (request.user_id, request.idempotency_key),
+                request.SerializeToString(deterministic=True),
+                lambda: self._process_order(request, context)
+            )
+        return await self._process_order(request, context)
+
+    async def _accept_order(self, request, context):
+        error = validate_order(request)
+        if error:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(error)
+            return main_pb2.ProcessOrderResponse()
+
+        items = [
+            {"product_id": item.product_id, "quantity": item.quantity, "price": item.price}
+            for item in request.items
+        ]
         try:
-            logger.info(colored(f"Processing order for user: {request.user_id}", "cyan"))
+            ticket = await self.outbox.enqueue(
+                request.user_id, items, request.idempotency_key,
+                user_verified=self._token_user_id(context) == request.user_id
+            )
+        except OutboxFull as e:
+            logger.warning("Rejecting order, outbox is full: %s", e)
+            context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+            context.set_details('Too many orders waiting, retry later')
+            return main_pb2.ProcessOrderResponse()
+        if ticket['items'] != items:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details('Idempotency key was already used for a different order')
+            return main_pb2.ProcessOrderResponse()
+
+        logger.info("Order accepted with ticket: %s", ticket['_id'])
+        return main_pb2.ProcessOrderResponse(
+            order_id=ticket_id(ticket['_id']),
+            status=ACCEPTED,
+            message="Order accepted for processing"
+        )
+
+    async def _create_accepted_orders(self, entries):
+        return await asyncio.gather(
+            *(self._create_accepted_order(entry) for entry in entries), return_exceptions=True
+        )
+
+    async def _create_accepted_order(self, entry):
+        if not entry['user_verified'] and await self.user_cache.get(entry['user_id']) is None:
+            raise Rejected('User not found')
+        # keyed by the ticket, so replaying an entry after a crash cannot create a second order
+        order_response = await self.order_calls.write(
+            'CreateOrder',
+            order_pb2.CreateOrderRequest(
+                user_id=entry['user_id'],
+                items=[order_pb2.OrderItem(**item) for item in entry['items']],
+                idempotency_key=f"outbox:{entry['_id']}"
+            ),
+            idempotent=True
+        )
+        return order_response.order_id
+
+    async def _ticket_status(self, ticket):
+        entry_id = parse_ticket(ticket)
+        if entry_id is None or self.outbox is None:
+            return None
+        entry = await self.outbox.get(entry_id)
+        if entry is None:
+            return None
+        if entry['status'] == DONE:
+            return await self.order_cache.get(entry['order_id'])
+        return main_pb2.GetOrderStatusResponse(
+            order_id=ticket,
+            status=entry['status'] if entry['status'] in (REJECTED, FAILED) else ACCEPTED,
+            items=[main_pb2.OrderItem(**item) for item in entry['items']],
+            total_amount=sum(item['price'] * item['quantity'] for item in entry['items']),
+            created_at=entry['created_at'].isoformat()
+        )
+
+    async def _process_order(self, request, context):
+        try:
+            logger.info("Processing order for user: %s", request.user_id)
+            if self.outbox is not None:
+                return await self._accept_order(request, context)
             
             try:
-                user_response = await self.user_stub.GetUser(
-                    user_pb2.GetUserRequest(user_id=request.user_id)
-                )
-                if not user_response or not user_response.user_id:
-                    logger.warning(colored(f"User not found: {request.user_id}", "yellow"))
+                # a valid token for this user already proves it exists, no lookup needed
+                if (self._token_user_id(context) != request.user_id
+                        and await self.user_cache.get(request.user_id) is None):
+                    logger.warning("User not found: %s", request.user_id)
                     context.set_code(grpc.StatusCode.NOT_FOUND)
                     context.set_details('User not found')
                     return main_pb2.ProcessOrderResponse()
             except grpc.RpcError as e:
-                logger.error(colored(f"Error verifying user: {str(e)}", "red"))
+                logger.error("Error verifying user: %s", e)
                 context.set_code(e.code())
                 context.set_details(e.details())
                 return main_pb2.ProcessOrderResponse()
@@ -51,14 +267,18 @@ class MainService(main_pb2_grpc.MainServiceServicer):
                     ) for item in request.items
                 ]
                 
-                order_response = await self.order_stub.CreateOrder(
+                # with a key OrderService deduplicates, so retrying the write is safe
+                order_response = await self.order_calls.write(
+                    'CreateOrder',
                     order_pb2.CreateOrderRequest(
                         user_id=request.user_id,
-                        items=order_items
-                    )
+                        items=order_items,
+                        idempotency_key=request.idempotency_key
+                    ),
+                    idempotent=bool(request.idempotency_key)
                 )
                 
-                logger.info(colored(f"Order created successfully: {order_response.order_id}", "green"))
+                logger.info("Order created successfully: %s", order_response.order_id)
                 
                 return main_pb2.ProcessOrderResponse(
                     order_id=order_response.order_id,
@@ -66,69 +286,83 @@ class MainService(main_pb2_grpc.MainServiceServicer):
                     message="Order processed successfully"
                 )
             except grpc.RpcError as e:
-                logger.error(colored(f"Error creating order: {str(e)}", "red"))
+                logger.error("Error creating order: %s", e)
                 context.set_code(e.code())
                 context.set_details(e.details())
                 return main_pb2.ProcessOrderResponse()
 
         except Exception as e:
-            logger.error(colored(f"Error processing order: {str(e)}", "red"))
+            logger.error("Error processing order: %s", e)
             context.set_code(grpc.StatusCode.INTERNAL)
             context.set_details('Internal error occurred')
             return main_pb2.ProcessOrderResponse()
 
     async def GetOrderStatus(self, request, context):
         try:
-            logger.info(colored(f"Getting order status for order: {request.order_id}", "cyan"))
+            logger.info("Getting order status for order: %s", request.order_id)
+            bind_deadline(context)
             
             try:
-                order_response = await self.order_stub.GetOrder(
-                    order_pb2.GetOrderRequest(order_id=request.order_id)
-                )
+                if is_ticket(request.order_id):
+                    status_response = await self._ticket_status(request.order_id)
+                else:
+                    status_response = await self.order_cache.get(request.order_id)
                 
-                if not order_response or not order_response.order_id:
-                    logger.warning(colored(f"Order not found: {request.order_id}", "yellow"))
+                if status_response is None:
+                    logger.warning("Order not found: %s", request.order_id)
                     context.set_code(grpc.StatusCode.NOT_FOUND)
                     context.set_details('Order not found')
                     return main_pb2.GetOrderStatusResponse()
                 
-                items = [
-                    main_pb2.OrderItem(
-                        product_id=item.product_id,
-                        quantity=item.quantity,
-                        price=item.price
-                    ) for item in order_response.items
-                ]
-                
-                return main_pb2.GetOrderStatusResponse(
-                    order_id=order_response.order_id,
-                    status=order_response.status,
-                    items=items,
-                    total_amount=order_response.total_amount,
-                    created_at=order_response.created_at
-                )
+                return status_response
             
             except grpc.RpcError as e:
-                logger.error(colored(f"Error getting order status: {str(e)}", "red"))
+                logger.error("Error getting order status: %s", e)
                 context.set_code(e.code())
                 context.set_details(e.details())
                 return main_pb2.GetOrderStatusResponse()
 
         except Exception as e:
-            logger.error(colored(f"Error getting order status: {str(e)}", "red"))
+            logger.error("Error getting order status: %s", e)
             context.set_code(grpc.StatusCode.INTERNAL)
             context.set_details('Internal error occurred')
             return main_pb2.GetOrderStatusResponse()
 
+def log_task_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Background task failed: %r", task.exception(), exc_info=task.exception())
+
 async def serve():
-    server = grpc.aio.server(futures.ThreadPoolExecutor(max_workers=10))
-    main_pb2_grpc.add_MainServiceServicer_to_server(MainService(), server)
+    server = grpc.aio.server(
+        futures.ThreadPoolExecutor(max_workers=10),
+        interceptors=[
+            logs.RequestIdInterceptor(),
+            metrics.ServerMetricsInterceptor(),
+            ConcurrencyLimitInterceptor(),
+        ],
+        options=supervisor.SERVER_OPTIONS
+    )
+    servicer = MainService()
+    main_pb2_grpc.add_MainServiceServicer_to_server(servicer, server)
+    readiness = Readiness(server, [main_pb2.DESCRIPTOR.services_by_name['MainService'].full_name])
+    await readiness.start(servicer.warm_up_steps())
     listen_addr = '[::]:50050'
     server.add_insecure_port(listen_addr)
-    logger.info(colored(f"Starting server on {listen_addr}", "green"))
+    logger.info("Starting server on %s", listen_addr)
     await server.start()
-    await server.wait_for_termination()
+    await metrics.start_http_server(supervisor.worker_port(metrics.METRICS_PORT))
+    tasks = [asyncio.create_task(servicer.order_cache.watch(servicer.watch_order_changes))]
+    if servicer.outbox is not None:
+        tasks.append(asyncio.create_task(servicer.outbox.run()))
+    for task in tasks:
+        # nothing awaits these until shutdown, so a failure would otherwise go unnoticed
+        task.add_done_callback(log_task_failure)
+    try:
+        await supervisor.wait_for_shutdown(server, before_stop=readiness.stop)
+    finally:
+        for task in tasks:
+            task.cancel()
 
 if __name__ == '__main__':
-    logger.info(colored("Main service starting...", "green"))
-    asyncio.run(serve())
+    logger.info("Main service starting...")
+    supervisor.run(serve)
@@ -0,0 +1,121 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+import grpc
+
+ORDER_CACHE_MAX_BYTES = int(os.getenv('ORDER_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+ORDER_CACHE_TTL = float(os.getenv('ORDER_CACHE_TTL', '30'))
+ORDER_WATCH_MAX_BACKOFF = float(os.getenv('ORDER_WATCH_MAX_BACKOFF', '10'))
+
+logger = logging.getLogger(os.getenv('SERVICE_NAME', 'MAIN_SERVICE'))
+
+
+class OrderCache:
+    """Read-through cache of GetOrderStatusResponse, bounded by serialized size.
+
+    Entries are dropped as soon as the order change stream reports the order,
+    with the TTL only as a safety net. Nothing is cached while the stream is
+    down, because invalidations could be missed in that gap.
+    """
+
+    def __init__(self, fetch, max_bytes=ORDER_CACHE_MAX_BYTES, ttl=ORDER_CACHE_TTL):
+        self._fetch = fetch
+        self._entries = OrderedDict()
+        self._loading = {}
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size_bytes = 0
+        self.live = False
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    async def get(self, order_id):
+        entry = self._entries.get(order_id)
+        if entry is not None:
+            expires_at, response, _ = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(order_id)
+                self.hits += 1
+                return response
+            self._drop(order_id)
+
+        self.misses += 1
+        token = object()
+        self._loading[order_id] = token
+        try:
+            response = await self._fetch(order_id)
+        finally:
+            # an invalidation while loading removes the token, so stale data is not stored
+            stored_token = self._loading.get(order_id)
+            if stored_token is token:
+                del self._loading[order_id]
+        if response is not None and stored_token is token and self.live:
+            self._store(order_id, response)
+        return response
+
+    def _store(self, order_id, response):
+        size = response.ByteSize()
+        if size > self.max_bytes:
+            return
+        self._drop(order_id)
+        self._entries[order_id] = (time.monotonic() + self.ttl, response, size)
+        self.size_bytes += size
+        while self.size_bytes > self.max_bytes:
+            _, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self.size_bytes -= evicted_size
+
+    def _drop(self, order_id):
+        entry = self._entries.pop(order_id, None)
+        if entry is not None:
+            self.size_bytes -= entry[2]
+
+    def invalidate(self, order_id):
+        self.invalidations += 1
+        self._drop(order_id)
+        self._loading.pop(order_id, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._loading.clear()
+        self.size_bytes = 0
+
+    async def watch(self, subscribe):
+        """Apply invalidations from `subscribe()` forever, resubscribing on failure."""
+        backoff = 0.5
+        while True:
+            call = subscribe()
+            try:
+                # the server sends initial metadata once it has registered the subscription
+                await call.initial_metadata()
+                if not call.done():
+                    # loads started during the gap may have read data we never got invalidations for
+                    self.clear()
+                    self.live = True
+                    backoff = 0.5
+                    logger.info("Subscribed to order changes, order cache enabled")
+                async for change in call:
+                    self.invalidate(change.order_id)
+                logger.warning("Order change stream ended, flushing order cache")
+            except grpc.RpcError as e:
+                logger.warning("Order change stream lost, flushing order cache: %s", e.code())
+            except asyncio.CancelledError:
+                call.cancel()
+                raise
+            finally:
+                self.live = False
+                self.clear()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, ORDER_WATCH_MAX_BACKOFF)
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'bytes': self.size_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'live': self.live,
+        }
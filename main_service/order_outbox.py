@@ -0,0 +1,220 @@
+import os
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from bson import ObjectId
+
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', '4'))
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '20'))
+OUTBOX_MAX_PENDING = int(os.getenv('OUTBOX_MAX_PENDING', '10000'))
+OUTBOX_LEASE_SECONDS = float(os.getenv('OUTBOX_LEASE_SECONDS', '30'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '5'))
+OUTBOX_RETRY_DELAY = float(os.getenv('OUTBOX_RETRY_DELAY', '1'))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '1'))
+# keep at least IDEMPOTENCY_TTL_SECONDS of OrderService, so a client key expires in both places together
+OUTBOX_RETENTION_SECONDS = int(os.getenv('OUTBOX_RETENTION_SECONDS', str(24 * 3600)))
+
+logger = logging.getLogger(os.getenv('SERVICE_NAME', 'MAIN_SERVICE'))
+
+ACCEPTED = 'ACCEPTED'
+PROCESSING = 'PROCESSING'
+DONE = 'DONE'
+REJECTED = 'REJECTED'
+FAILED = 'FAILED'
+
+# tells ticket ids apart from order ids, so polling a ticket skips the order lookup
+TICKET_PREFIX = 'ticket-'
+
+
+def ticket_id(entry_id):
+    return f"{TICKET_PREFIX}{entry_id}"
+
+
+def is_ticket(value):
+    return value.startswith(TICKET_PREFIX)
+
+
+def parse_ticket(value):
+    """The outbox entry id of a ticket id, or None if it is not one."""
+    entry_id = value[len(TICKET_PREFIX):]
+    if not is_ticket(value) or not ObjectId.is_valid(entry_id):
+        return None
+    return ObjectId(entry_id)
+
+
+class OutboxFull(Exception):
+    pass
+
+
+class Rejected(Exception):
+    """Raised by the processor for entries that can never succeed."""
+
+
+class OrderOutbox:
+    """Durable queue of accepted orders, drained by a pool of asyncio workers.
+
+    Each worker claims up to `batch_size` entries by taking a lease on them
+    and hands the batch to `process(entries)`, which returns one result per
+    entry: an order id, a Rejected, or any other exception to retry later.
+    An entry whose lease runs out (e.g. the process died mid-batch) is
+    claimed again, so `process` must be idempotent per entry. Finished
+    entries, and with them their idempotency keys, are deleted by a TTL
+    index `retention_seconds` after they finished.
+    """
+
+    def __init__(self, collection, process, workers=OUTBOX_WORKERS, batch_size=OUTBOX_BATCH_SIZE,
+                 max_pending=OUTBOX_MAX_PENDING, lease_seconds=OUTBOX_LEASE_SECONDS,
+                 max_attempts=OUTBOX_MAX_ATTEMPTS, retention_seconds=OUTBOX_RETENTION_SECONDS):
+        self.collection = collection
+        self._process = process
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.lease = timedelta(seconds=lease_seconds)
+        self.max_attempts = max_attempts
+        self.retention_seconds = retention_seconds
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self._wakeup = asyncio.Event()
+
+    async def ensure_indexes(self):
+        await self.collection.create_index(
+            [("status", ASCENDING), ("available_at", ASCENDING)], name="status_available"
+        )
+        await self.collection.create_index(
+            [("user_id", ASCENDING), ("idempotency_key", ASCENDING)],
+            name="user_idempotency_key", unique=True,
+            partialFilterExpression={"idempotency_key": {"$exists": True}}
+        )
+        # entries still queued have no finished_at, so the TTL monitor leaves them alone
+        await self.collection.create_index(
+            "finished_at", expireAfterSeconds=self.retention_seconds, name="finished_ttl"
+        )
+
+    async def enqueue(self, user_id, items, idempotency_key="", user_verified=False):
+        if self.pending >= self.max_pending:
+            raise OutboxFull(f"{self.pending} orders waiting")
+        now = datetime.utcnow()
+        entry = {
+            "user_id": user_id,
+            "items": items,
+            "user_verified": user_verified,
+            "status": ACCEPTED,
+            "attempts": 0,
+            "available_at": now,
+            "created_at": now
+        }
+        if idempotency_key:
+            entry["idempotency_key"] = idempotency_key
+        try:
+            await self.collection.insert_one(entry)
+        except DuplicateKeyError:
+            return await self.collection.find_one({"user_id": user_id, "idempotency_key": idempotency_key})
+        self.pending += 1
+        self._wakeup.set()
+        return entry
+
+    async def get(self, ticket_id):
+        return await self.collection.find_one({"_id": ticket_id})
+
+    async def run(self):
+        try:
+            self.pending = await self.collection.count_documents({"status": {"$in": [ACCEPTED, PROCESSING]}})
+        except Exception as e:
+            logger.error("Error counting pending outbox entries: %s", e)
+        await asyncio.gather(*(self._supervise(index) for index in range(self.workers)))
+
+    async def _supervise(self, index):
+        """Runs one worker forever, restarting it if it crashes; its claimed entries come back when their lease runs out."""
+        while True:
+            try:
+                await self._worker()
+            except Exception:
+                logger.exception("Outbox worker %s crashed, restarting in %ss", index, OUTBOX_RETRY_DELAY)
+                await asyncio.sleep(OUTBOX_RETRY_DELAY)
+
+    async def _worker(self):
+        while True:
+            try:
+                entries = await self._claim_batch()
+            except Exception as e:
+                logger.error("Error claiming outbox entries: %s", e)
+                entries = []
+            if not entries:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), OUTBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                results = await self._process(entries)
+            except Exception as e:
+                results = [e] * len(entries)
+            outcomes = await asyncio.gather(*(
+                self._finish(entry, result) for entry, result in zip(entries, results)
+            ), return_exceptions=True)
+            for entry, outcome in zip(entries, outcomes):
+                # the entry stays leased and is claimed again once the lease runs out
+                if isinstance(outcome, Exception):
+                    logger.error("Error finishing outbox entry %s: %s", entry["_id"], outcome)
+
+    def _claimable(self, now):
+        return {"$or": [
+            {"status": ACCEPTED, "available_at": {"$lte": now}},
+            # a lease that ran out belongs to a worker that crashed or hung
+            {"status": PROCESSING, "lease_until": {"$lte": now}},
+        ]}
+
+    async def _claim_batch(self):
+        now = datetime.utcnow()
+        candidates = await self.collection.find(self._claimable(now), {"_id": 1}) \
+            .sort("available_at", ASCENDING).limit(self.batch_size).to_list(self.batch_size)
+        claimed = []
+        for candidate in candidates:
+            entry = await self.collection.find_one_and_update(
+                {"_id": candidate["_id"], **self._claimable(now)},
+                {"$set": {"status": PROCESSING, "lease_until": now + self.lease},
+                 "$inc": {"attempts": 1}},
+                return_document=ReturnDocument.AFTER
+            )
+            # another worker may have claimed it in the meantime
+            if entry is not None:
+                claimed.append(entry)
+        return claimed
+
+    async def _finish(self, entry, result):
+        if isinstance(result, Rejected):
+            update = {"status": REJECTED, "error": str(result)}
+        elif isinstance(result, BaseException):
+            if entry["attempts"] < self.max_attempts:
+                retry_at = datetime.utcnow() + timedelta(seconds=OUTBOX_RETRY_DELAY * entry["attempts"])
+                await self.collection.update_one(
+                    {"_id": entry["_id"], "status": PROCESSING},
+                    {"$set": {"status": ACCEPTED, "available_at": retry_at, "error": str(result)}}
+                )
+                return
+            update = {"status": FAILED, "error": str(result)}
+        else:
+            update = {"status": DONE, "order_id": result}
+
+        update["finished_at"] = datetime.utcnow()
+        outcome = await self.collection.update_one(
+            {"_id": entry["_id"], "status": PROCESSING}, {"$set": update}
+        )
+        if outcome.modified_count:
+            self.pending = max(0, self.pending - 1)
+            if update["status"] == DONE:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'completed': self.completed,
+            'failed': self.failed,
+        }
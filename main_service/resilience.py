@@ -0,0 +1,193 @@
+import os
+import time
+import random
+import asyncio
+import contextvars
+from collections import deque
+import grpc
+
+import metrics
+
+# used when the incoming RPC carries no deadline of its own
+OUTBOUND_DEFAULT_DEADLINE = float(os.getenv('OUTBOUND_DEFAULT_DEADLINE', '5'))
+# time kept back from the caller's deadline to send our own response
+OUTBOUND_DEADLINE_MARGIN = float(os.getenv('OUTBOUND_DEADLINE_MARGIN', '0.01'))
+READ_ATTEMPT_TIMEOUT = float(os.getenv('READ_ATTEMPT_TIMEOUT', '1'))
+READ_MAX_ATTEMPTS = int(os.getenv('READ_MAX_ATTEMPTS', '3'))
+RETRY_BASE_BACKOFF = float(os.getenv('RETRY_BASE_BACKOFF', '0.01'))
+RETRY_MAX_BACKOFF = float(os.getenv('RETRY_MAX_BACKOFF', '0.2'))
+RETRY_BUDGET_RATIO = float(os.getenv('RETRY_BUDGET_RATIO', '0.1'))
+RETRY_BUDGET_MAX_TOKENS = float(os.getenv('RETRY_BUDGET_MAX_TOKENS', '10'))
+HEDGE_READS = os.getenv('HEDGE_READS', 'false').lower() == 'true'
+HEDGE_QUANTILE = float(os.getenv('HEDGE_QUANTILE', '0.95'))
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', '0.002'))
+
+RETRYABLE_CODES = frozenset((grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED))
+
+RETRIES = metrics.REGISTRY.counter(
+    'outbound_retries_total', 'Attempts retried after a retryable error.', ('target', 'method'))
+HEDGES = metrics.REGISTRY.counter(
+    'outbound_hedges_total', 'Hedged second reads sent.', ('target', 'method'))
+BUDGET_EXHAUSTED = metrics.REGISTRY.counter(
+    'outbound_retry_budget_exhausted_total', 'Retries or hedges skipped for lack of budget.', ('target',))
+
+deadline_var = contextvars.ContextVar('deadline', default=None)
+
+
+def bind_deadline(context):
+    """Records the incoming RPC's deadline for the outbound calls it makes."""
+    remaining = context.time_remaining()
+    if remaining is None:
+        remaining = OUTBOUND_DEFAULT_DEADLINE
+    deadline_var.set(time.monotonic() + remaining - OUTBOUND_DEADLINE_MARGIN)
+
+
+def time_remaining():
+    deadline = deadline_var.get()
+    if deadline is None:
+        return OUTBOUND_DEFAULT_DEADLINE
+    return deadline - time.monotonic()
+
+
+class DeadlineExceeded(grpc.RpcError):
+    """Raised without calling out when the caller's deadline has already passed."""
+
+    def code(self):
+        return grpc.StatusCode.DEADLINE_EXCEEDED
+
+    def details(self):
+        return 'Deadline exceeded before the call was sent'
+
+
+class RetryBudget:
+    """Token bucket shared by all reads to one backend.
+
+    Every call deposits `ratio` tokens and every retry or hedge spends one,
+    so extra load stays around `ratio` of the traffic even when the backend
+    fails every request.
+    """
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, max_tokens=RETRY_BUDGET_MAX_TOKENS):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+
+    def deposit(self):
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class LatencyTracker:
+    """Recent successful latencies of one method; the quantile is recomputed every `refresh` samples."""
+
+    def __init__(self, quantile=HEDGE_QUANTILE, window=1000, min_samples=50, refresh=100):
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.refresh = refresh
+        self._samples = deque(maxlen=window)
+        self._since_refresh = 0
+        self.value = None
+
+    def observe(self, latency):
+        self._samples.append(latency)
+        self._since_refresh += 1
+        if self._since_refresh >= self.refresh and len(self._samples) >= self.min_samples:
+            self._since_refresh = 0
+            ordered = sorted(self._samples)
+            self.value = ordered[min(len(ordered) - 1, int(len(ordered) * self.quantile))]
+
+
+class OutboundCalls:
+    """Deadline-bound calls to one backend's stub.
+
+    Reads are retried on UNAVAILABLE/DEADLINE_EXCEEDED with jittered
+    exponential backoff and, if enabled, hedged with a second attempt once
+    the first is slower than the method's recent p95. Writes get a deadline
+    only unless marked idempotent (e.g. keyed by an idempotency key): the
+    first attempt may have applied, so they are not retried blindly.
+    """
+
+    def __init__(self, target, stub, hedging=HEDGE_READS, max_attempts=READ_MAX_ATTEMPTS,
+                 attempt_timeout=READ_ATTEMPT_TIMEOUT):
+        self.target = target
+        self.stub = stub
+        self.hedging = hedging
+        self.max_attempts = max_attempts
+        self.attempt_timeout = attempt_timeout
+        self.budget = RetryBudget()
+        self._latency = {}
+
+    async def write(self, method, request, idempotent=False):
+        if idempotent:
+            return await self._retrying(method, request, hedge=False)
+        remaining = time_remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded()
+        return await getattr(self.stub, method)(request, timeout=remaining)
+
+    async def read(self, method, request):
+        return await self._retrying(method, request, hedge=self.hedging)
+
+    async def _retrying(self, method, request, hedge):
+        self.budget.deposit()
+        attempt = 1
+        while True:
+            try:
+                return await self._hedged_attempt(method, request, hedge)
+            except grpc.RpcError as e:
+                if e.code() not in RETRYABLE_CODES or attempt >= self.max_attempts:
+                    raise
+                backoff = random.uniform(0, min(RETRY_MAX_BACKOFF, RETRY_BASE_BACKOFF * 2 ** attempt))
+                if time_remaining() <= backoff:
+                    raise
+                if not self.budget.withdraw():
+                    BUDGET_EXHAUSTED.labels(self.target).inc()
+                    raise
+                RETRIES.labels(self.target, method).inc()
+                attempt += 1
+                await asyncio.sleep(backoff)
+
+    async def _attempt(self, method, request, tracker):
+        remaining = time_remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded()
+        started = time.perf_counter()
+        response = await getattr(self.stub, method)(
+            request, timeout=min(remaining, self.attempt_timeout)
+        )
+        tracker.observe(time.perf_counter() - started)
+        return response
+
+    async def _hedged_attempt(self, method, request, hedge):
+        tracker = self._latency.get(method)
+        if tracker is None:
+            tracker = self._latency[method] = LatencyTracker()
+        if not hedge or tracker.value is None:
+            return await self._attempt(method, request, tracker)
+
+        first = asyncio.ensure_future(self._attempt(method, request, tracker))
+        pending = {first}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=max(tracker.value, HEDGE_MIN_DELAY))
+            if not done and time_remaining() > 0:
+                if self.budget.withdraw():
+                    HEDGES.labels(self.target, method).inc()
+                    pending.add(asyncio.ensure_future(self._attempt(method, request, tracker)))
+                else:
+                    BUDGET_EXHAUSTED.labels(self.target).inc()
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
@@ -0,0 +1,78 @@
+import os
+import time
+import asyncio
+from collections import OrderedDict
+
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '60'))
+USER_CACHE_NEGATIVE_TTL = float(os.getenv('USER_CACHE_NEGATIVE_TTL', '5'))
+
+
+class UserCache:
+    """LRU + TTL cache of user lookups.
+
+    `fetch(user_id)` must return the user or None when it does not exist;
+    None results are cached for `negative_ttl`. Errors are not cached, and
+    concurrent misses for the same id share a single fetch.
+    """
+
+    def __init__(self, fetch, max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL,
+                 negative_ttl=USER_CACHE_NEGATIVE_TTL):
+        self._fetch = fetch
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            expires_at, user = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return user
+            del self._entries[user_id]
+
+        task = self._inflight.get(user_id)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._load(user_id))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._inflight[user_id] = task
+        else:
+            self.coalesced += 1
+        # shield so a cancelled caller does not cancel the lookup the others wait on
+        return await asyncio.shield(task)
+
+    async def _load(self, user_id):
+        try:
+            user = await self._fetch(user_id)
+            self._store(user_id, user)
+            return user
+        finally:
+            del self._inflight[user_id]
+
+    def _store(self, user_id, user):
+        ttl = self.ttl if user is not None else self.negative_ttl
+        if ttl <= 0:
+            return
+        self._entries[user_id] = (time.monotonic() + ttl, user)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+        }
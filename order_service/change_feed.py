@@ -0,0 +1,33 @@
+import os
+import asyncio
+
+CHANGE_FEED_QUEUE_SIZE = int(os.getenv('CHANGE_FEED_QUEUE_SIZE', '10000'))
+
+
+class ChangeFeed:
+    """Fan-out of committed (order_id, status) changes to stream subscribers.
+
+    A subscriber that falls `queue_size` changes behind is dropped: its
+    queue gets a None marker so the stream ends and the client resubscribes
+    with an empty cache instead of silently missing invalidations.
+    """
+
+    def __init__(self, queue_size=CHANGE_FEED_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers = set()
+
+    def subscribe(self):
+        queue = asyncio.Queue(maxsize=self.queue_size + 1)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._subscribers.discard(queue)
+
+    def publish(self, order_id, status):
+        for queue in list(self._subscribers):
+            if queue.qsize() >= self.queue_size:
+                self._subscribers.discard(queue)
+                queue.put_nowait(None)
+            else:
+                queue.put_nowait((order_id, status))
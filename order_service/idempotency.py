@@ -0,0 +1,52 @@
+import os
+import hashlib
+from datetime import datetime
+from pymongo.errors import DuplicateKeyError
+
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_TTL_SECONDS', str(24 * 3600)))
+
+DUPLICATE_KEY = 11000
+
+
+def request_fingerprint(request):
+    """Hash of the request without its idempotency key, to catch a key reused for a different order."""
+    unkeyed = type(request)()
+    unkeyed.CopyFrom(request)
+    unkeyed.idempotency_key = ''
+    return hashlib.sha256(unkeyed.SerializeToString(deterministic=True)).hexdigest()
+
+
+class IdempotencyStore:
+    """Maps (user_id, idempotency key) to the order id that key created.
+
+    A key is claimed with an insert on the unique `_id`, so of several
+    concurrent requests exactly one claims it and the others get that
+    claim back. Claims expire after `ttl` seconds via a TTL index.
+    """
+
+    def __init__(self, collection, ttl=IDEMPOTENCY_TTL_SECONDS):
+        self.collection = collection
+        self.ttl = ttl
+
+    async def ensure_indexes(self):
+        await self.collection.create_index(
+            "created_at", expireAfterSeconds=self.ttl, name="idempotency_ttl"
+        )
+
+    async def claim(self, user_id, key, fingerprint, order_id):
+        """Returns None if the key was claimed for `order_id`, else the existing claim."""
+        claim_id = f"{user_id}:{key}"
+        while True:
+            try:
+                await self.collection.insert_one({
+                    "_id": claim_id,
+                    "order_id": order_id,
+                    "fingerprint": fingerprint,
+                    "created_at": datetime.utcnow()
+                })
+                return None
+            except DuplicateKeyError:
+                existing = await self.collection.find_one({"_id": claim_id})
+                # the claim may have expired between the insert and the read
+                if existing is not None:
+                    return existing
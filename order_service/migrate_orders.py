@@ -0,0 +1,84 @@
+"""Converts orders stored in the legacy format to the compact one, batch by batch.
+
+    python migrate_orders.py --batch-size 500 --pause 0.05
+
+Runs while the service keeps serving: OrderService reads both formats as long
+as ORDER_LEGACY_READS is on. Progress is checkpointed after every batch, so an
+interrupted run resumes where it stopped. Once it reports no legacy orders
+left, set ORDER_LEGACY_READS=false and rerun with --drop-legacy-indexes.
+"""
+import asyncio
+import argparse
+from pymongo import ASCENDING, ReplaceOne
+
+import order_service
+from order_schema import LEGACY_FIELDS, CREATED_AT, compact_order
+
+CHECKPOINT_ID = 'orders_compact'
+LEGACY_ORDERS = {LEGACY_FIELDS[CREATED_AT]: {"$exists": True}}
+
+
+async def migrate_batch(orders, batch):
+    """Replaces each document only if it is still the version that was read."""
+    while batch:
+        await orders.bulk_write([
+            ReplaceOne({"_id": doc["_id"], **LEGACY_ORDERS, "status": doc["status"]}, compact_order(doc))
+            for doc in batch
+        ], ordered=False)
+        # anything still in the legacy format changed status in the meantime; convert the new version
+        batch = await orders.find(
+            {"_id": {"$in": [doc["_id"] for doc in batch]}, **LEGACY_ORDERS}
+        ).to_list(None)
+
+
+async def migrate(orders, checkpoints, batch_size, pause):
+    checkpoint = await checkpoints.find_one({"_id": CHECKPOINT_ID}) or {}
+    last_id = checkpoint.get("last_id")
+    migrated = checkpoint.get("migrated", 0)
+    while True:
+        query = dict(LEGACY_ORDERS)
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = await orders.find(query).sort("_id", ASCENDING).limit(batch_size).to_list(batch_size)
+        if not batch:
+            # processes still on the old code may have written legacy orders behind the checkpoint
+            if last_id is None or not await orders.find_one(LEGACY_ORDERS, {"_id": 1}):
+                break
+            last_id = None
+            continue
+        await migrate_batch(orders, batch)
+        last_id = batch[-1]["_id"]
+        migrated += len(batch)
+        await checkpoints.update_one(
+            {"_id": CHECKPOINT_ID}, {"$set": {"last_id": last_id, "migrated": migrated}}, upsert=True
+        )
+        print({'migrated': migrated, 'last_id': str(last_id)})
+        await asyncio.sleep(pause)
+    return migrated
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--pause', type=float, default=0.05, help='seconds to sleep between batches')
+    parser.add_argument('--drop-legacy-indexes', action='store_true')
+    args = parser.parse_args()
+
+    orders = order_service.orders_collection
+    await order_service.ensure_indexes()
+    migrated = await migrate(orders, order_service.db.migrations, args.batch_size, args.pause)
+    remaining = await orders.count_documents(LEGACY_ORDERS)
+    print({'migrated': migrated, 'legacy_remaining': remaining})
+
+    if args.drop_legacy_indexes:
+        if remaining:
+            parser.error(f"{remaining} orders are still in the legacy format")
+        existing = await orders.index_information()
+        for name in order_service.ORDER_INDEXES:
+            if name in existing:
+                await orders.drop_index(name)
+                print({'dropped_index': name})
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
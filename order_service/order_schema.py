@@ -0,0 +1,148 @@
+import os
+from datetime import datetime
+from order_pb2 import OrderResponse, OrderItem
+
+# documents written before the compact format are read (and updated) too,
+# until migrate_orders.py has converted all of them
+ORDER_LEGACY_READS = os.getenv('ORDER_LEGACY_READS', 'true').lower() in ('1', 'true', 'yes')
+
+USER_ID = 'u'
+ITEMS = 'i'
+PRODUCT_ID = 'p'
+QUANTITY = 'q'
+PRICE = 'c'
+STATUS = 's'
+TOTAL = 't'
+CREATED_AT = 'd'
+CANCELLED_IN = 'x'
+
+LEGACY_FIELDS = {
+    USER_ID: 'user_id',
+    ITEMS: 'items',
+    STATUS: 'status',
+    TOTAL: 'total_amount',
+    CREATED_AT: 'created_at',
+}
+
+LEGACY_FIELD_NAMES = frozenset(LEGACY_FIELDS.values())
+
+ORDER_PROJECTION = {USER_ID: 1, ITEMS: 1, STATUS: 1, TOTAL: 1, CREATED_AT: 1}
+SUMMARY_PROJECTION = {USER_ID: 1, TOTAL: 1, CREATED_AT: 1}
+STATUS_PROJECTION = {STATUS: 1}
+if ORDER_LEGACY_READS:
+    for _projection in (ORDER_PROJECTION, SUMMARY_PROJECTION, STATUS_PROJECTION):
+        _projection.update({LEGACY_FIELDS[field]: 1 for field in list(_projection)})
+
+
+def to_cents(amount):
+    return round(amount * 100)
+
+
+def now():
+    # BSON dates keep milliseconds, so truncate up front to return what a read would
+    moment = datetime.utcnow()
+    return moment.replace(microsecond=moment.microsecond // 1000 * 1000)
+
+
+def is_legacy(doc):
+    # works on projections too, which keep only some of the fields
+    return not LEGACY_FIELD_NAMES.isdisjoint(doc)
+
+
+def build_order_doc(request):
+    items = [{
+        PRODUCT_ID: item.product_id,
+        QUANTITY: item.quantity,
+        PRICE: to_cents(item.price)
+    } for item in request.items]
+    return {
+        USER_ID: request.user_id,
+        ITEMS: items,
+        STATUS: "PENDING",
+        TOTAL: sum(item[PRICE] * item[QUANTITY] for item in items),
+        CREATED_AT: now()
+    }
+
+
+def compact_order(doc):
+    """The compact form of a legacy order document, keeping its id."""
+    items = [{
+        PRODUCT_ID: item['product_id'],
+        QUANTITY: item['quantity'],
+        PRICE: to_cents(item['price'])
+    } for item in doc['items']]
+    compact = {
+        "_id": doc['_id'],
+        USER_ID: doc['user_id'],
+        ITEMS: items,
+        STATUS: doc['status'],
+        TOTAL: sum(item[PRICE] * item[QUANTITY] for item in items),
+        CREATED_AT: datetime.fromisoformat(doc['created_at'])
+    }
+    if CANCELLED_IN in doc:
+        compact[CANCELLED_IN] = doc[CANCELLED_IN]
+    return compact
+
+
+def legacy_query(query):
+    """The same filter against documents in the legacy format."""
+    legacy = {}
+    for key, value in query.items():
+        if key in ('$or', '$and'):
+            legacy[key] = [legacy_query(part) for part in value]
+        else:
+            legacy[LEGACY_FIELDS.get(key, key)] = _legacy_value(value)
+    return legacy
+
+
+def _legacy_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return {key: _legacy_value(part) for key, part in value.items()}
+    return value
+
+
+def order_status(doc):
+    return doc['status'] if is_legacy(doc) else doc[STATUS]
+
+
+def order_created_at(doc):
+    if is_legacy(doc):
+        return datetime.fromisoformat(doc['created_at'])
+    return doc[CREATED_AT]
+
+
+def order_summary(doc):
+    """(user_id, day, total in cents) of an order in either format."""
+    if is_legacy(doc):
+        return doc['user_id'], doc['created_at'][:10], to_cents(doc['total_amount'])
+    return doc[USER_ID], doc[CREATED_AT].date().isoformat(), doc[TOTAL]
+
+
+def order_response(doc):
+    if is_legacy(doc):
+        return OrderResponse(
+            order_id=str(doc['_id']),
+            user_id=doc['user_id'],
+            items=[OrderItem(
+                product_id=item['product_id'],
+                quantity=item['quantity'],
+                price=item['price']
+            ) for item in doc['items']],
+            status=doc['status'],
+            total_amount=doc['total_amount'],
+            created_at=doc['created_at']
+        )
+    return OrderResponse(
+        order_id=str(doc['_id']),
+        user_id=doc[USER_ID],
+        items=[OrderItem(
+            product_id=item[PRODUCT_ID],
+            quantity=item[QUANTITY],
+            price=item[PRICE] / 100
+        ) for item in doc[ITEMS]],
+        status=doc[STATUS],
+        total_amount=doc[TOTAL] / 100,
+        created_at=doc[CREATED_AT].isoformat()
+    )
@@ -1,153 +1,533 @@
 import os
+import heapq
 import asyncio
-import logging
+import functools
 from concurrent import futures
 import grpc
-from termcolor import colored
 import motor.motor_asyncio
 from datetime import datetime
+import order_pb2
 from order_pb2 import (
     CreateOrderRequest,
     OrderResponse,
     GetOrderRequest,
     UpdateOrderStatusRequest,
-    OrderItem
+    CreateOrderResult,
+    CreateOrdersResponse,
+    ListOrdersRequest,
+    ListOrdersResponse,
+    ExportOrdersRequest,
+    BulkUpdateOrderStatusResponse,
+    OrderChange,
+    GetUserStatsRequest,
+    DailyUserStats,
+    UserStatsResponse
 )
 import order_pb2_grpc
+import json
+import base64
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, WriteError
+from write_coalescer import WriteCoalescer
+from order_status import ORDER_STATUSES, transition_filter
+from order_schema import (
+    ORDER_LEGACY_READS, LEGACY_FIELDS, USER_ID, STATUS, CREATED_AT, CANCELLED_IN,
+    ORDER_PROJECTION, SUMMARY_PROJECTION, STATUS_PROJECTION,
+    build_order_doc, order_response, order_status, order_created_at, legacy_query
+)
+from change_feed import ChangeFeed
+from idempotency import DUPLICATE_KEY, IdempotencyStore, request_fingerprint
+from user_stats import UserStats
+import metrics
+from concurrency_limit import ConcurrencyLimitInterceptor
+import logs
+import supervisor
+from readiness import Readiness, ping_mongodb
 
-logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'))
-logger = logging.getLogger(os.getenv('SERVICE_NAME', 'ORDER_SERVICE'))
+logger = logs.setup_logging(os.getenv('SERVICE_NAME', 'ORDER_SERVICE'))
 
 MONGODB_URI = os.getenv('MONGODB_URI', 'mongodb://localhost:27017')
 MONGODB_DB = os.getenv('MONGODB_DB', 'orderdb')
 
 client = motor.motor_asyncio.AsyncIOMotorClient(MONGODB_URI)
 db = client[MONGODB_DB]
-orders_collection = db.orders
+orders_collection = metrics.InstrumentedCollection(db.orders)
+idempotency_store = IdempotencyStore(metrics.InstrumentedCollection(db.order_idempotency_keys))
+user_stats = UserStats(metrics.InstrumentedCollection(db.user_order_stats))
+
+ORDER_WRITE_COALESCING = os.getenv('ORDER_WRITE_COALESCING', 'false').lower() in ('1', 'true', 'yes')
+ORDER_COALESCE_MAX_BATCH = int(os.getenv('ORDER_COALESCE_MAX_BATCH', '100'))
+ORDER_COALESCE_MAX_DELAY_MS = float(os.getenv('ORDER_COALESCE_MAX_DELAY_MS', '5'))
+CREATE_ORDERS_BATCH_SIZE = int(os.getenv('CREATE_ORDERS_BATCH_SIZE', '500'))
+LIST_ORDERS_DEFAULT_PAGE_SIZE = int(os.getenv('LIST_ORDERS_DEFAULT_PAGE_SIZE', '20'))
+LIST_ORDERS_MAX_PAGE_SIZE = int(os.getenv('LIST_ORDERS_MAX_PAGE_SIZE', '100'))
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '500'))
+
+ORDER_INDEXES = {
+    "user_created": [(USER_ID, ASCENDING), (CREATED_AT, DESCENDING), ("_id", DESCENDING)],
+    "user_status_created": [(USER_ID, ASCENDING), (STATUS, ASCENDING), (CREATED_AT, DESCENDING), ("_id", DESCENDING)],
+    "created": [(CREATED_AT, ASCENDING), ("_id", ASCENDING)],
+}
+
+async def ensure_indexes():
+    for name, keys in ORDER_INDEXES.items():
+        await orders_collection.create_index(keys, name=f"compact_{name}")
+        if ORDER_LEGACY_READS:
+            await orders_collection.create_index(
+                [(LEGACY_FIELDS.get(field, field), direction) for field, direction in keys], name=name
+            )
+    await idempotency_store.ensure_indexes()
+    await user_stats.ensure_indexes()
+    logger.info("Order indexes are in place")
+
+def encode_cursor(order):
+    position = {"created_at": order_created_at(order).isoformat(), "id": str(order["_id"])}
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+def decode_cursor(cursor):
+    position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return datetime.fromisoformat(position["created_at"]), ObjectId(position["id"])
+
+def order_sort_key(order):
+    return order_created_at(order), order["_id"]
+
+async def merge_sorted(cursors, key):
+    """Merges cursors that are each sorted ascending by `key` into one ascending stream."""
+    iterators = [cursor.__aiter__() for cursor in cursors]
+    heads = []
+
+    async def advance(index):
+        try:
+            doc = await iterators[index].__anext__()
+        except StopAsyncIteration:
+            return
+        heapq.heappush(heads, (key(doc), index, doc))
+
+    for index in range(len(iterators)):
+        await advance(index)
+    while heads:
+        _, index, doc = heapq.heappop(heads)
+        yield doc
+        await advance(index)
 
 class OrderService(order_pb2_grpc.OrderServiceServicer):
+    def __init__(self, coalesce_writes=ORDER_WRITE_COALESCING, serve_changes=True):
+        self.changes = ChangeFeed()
+        self.serve_changes = serve_changes
+        self.coalescer = None
+        if coalesce_writes:
+            self.coalescer = WriteCoalescer(
+                orders_collection,
+                max_batch=ORDER_COALESCE_MAX_BATCH,
+                max_delay_ms=ORDER_COALESCE_MAX_DELAY_MS,
+                after_write=user_stats.record_created
+            )
+
+    async def _insert_order(self, order_doc):
+        if self.coalescer:
+            # the coalescer records the stats of its whole batch in one bulk_write
+            await self.coalescer.insert(order_doc)
+        else:
+            await orders_collection.insert_one(order_doc)
+            await user_stats.record_created([order_doc])
+        self.changes.publish(str(order_doc['_id']), order_doc[STATUS])
+
+    async def _transition(self, order_id, status):
+        query = transition_filter(order_id, status)
+        order = await orders_collection.find_one_and_update(
+            query, {"$set": {STATUS: status}},
+            projection=ORDER_PROJECTION, return_document=ReturnDocument.AFTER
+        )
+        if order is None and ORDER_LEGACY_READS:
+            order = await orders_collection.find_one_and_update(
+                legacy_query(query), {"$set": legacy_query({STATUS: status})},
+                projection=ORDER_PROJECTION, return_document=ReturnDocument.AFTER
+            )
+        return order
+
+    async def _create_idempotent(self, request, context):
+        fingerprint = request_fingerprint(request)
+        order_doc = build_order_doc(request)
+        order_doc['_id'] = ObjectId()
+        claim = await idempotency_store.claim(
+            request.user_id, request.idempotency_key, fingerprint, order_doc['_id']
+        )
+        if claim is None:
+            return await self._insert_claimed(order_doc)
+
+        if claim['fingerprint'] != fingerprint:
+            logger.warning("Idempotency key %s reused for a different order", request.idempotency_key)
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details('Idempotency key was already used for a different order')
+            return None
+
+        existing = await orders_collection.find_one({"_id": claim['order_id']}, ORDER_PROJECTION)
+        if existing is not None:
+            logger.info("Replaying order %s for idempotency key %s", existing['_id'], request.idempotency_key)
+            return existing
+
+        # the claiming request has not inserted yet (or died before it could); the order id is
+        # fixed by the claim, so inserting it here cannot create a second order
+        order_doc['_id'] = claim['order_id']
+        return await self._insert_claimed(order_doc)
+
+    async def _insert_claimed(self, order_doc):
+        """Inserts the order under its claimed id; whichever request with the key gets there first wins."""
+        try:
+            await self._insert_order(order_doc)
+        except WriteError as e:
+            if e.code != DUPLICATE_KEY:
+                raise
+            return await orders_collection.find_one({"_id": order_doc['_id']}, ORDER_PROJECTION)
+        return order_doc
+
     async def CreateOrder(self, request, context):
         try:
-            logger.info(colored(f"Creating order for user: {request.user_id}", "cyan"))
-            
-            items = [{
-                "product_id": item.product_id,
-                "quantity": item.quantity,
-                "price": item.price
-            } for item in request.items]
-            
-            total_amount = sum(item.price * item.quantity for item in request.items)
+            logger.info("Creating order for user: %s", request.user_id)
             
-            order_doc = {
-                "user_id": request.user_id,
-                "items": items,
-                "status": "PENDING",
-                "total_amount": total_amount,
-                "created_at": datetime.utcnow().isoformat()
-            }
-            
-            result = await orders_collection.insert_one(order_doc)
-            order_id = str(result.inserted_id)
+            if request.idempotency_key:
+                order_doc = await self._create_idempotent(request, context)
+                if order_doc is None:
+                    return OrderResponse()
+            else:
+                order_doc = build_order_doc(request)
+                await self._insert_order(order_doc)
             
-            logger.info(colored(f"Order created successfully with ID: {order_id}", "green"))
+            logger.info("Order created successfully with ID: %s", order_doc['_id'])
             
-            return OrderResponse(
-                order_id=order_id,
-                user_id=request.user_id,
-                items=[OrderItem(
-                    product_id=item["product_id"],
-                    quantity=item["quantity"],
-                    price=item["price"]
-                ) for item in items],
-                status="PENDING",
-                total_amount=total_amount,
-                created_at=order_doc["created_at"]
-            )
+            return order_response(order_doc)
         except Exception as e:
-            logger.error(colored(f"Error creating order: {str(e)}", "red"))
+            logger.error("Error creating order: %s", e)
             context.set_code(grpc.StatusCode.INTERNAL)
             context.set_details('Internal error occurred')
             return OrderResponse()
 
     async def GetOrder(self, request, context):
         try:
-            logger.info(colored(f"Getting order with ID: {request.order_id}", "cyan"))
+            logger.info("Getting order with ID: %s", request.order_id)
             
-            from bson import ObjectId
-            order = await orders_collection.find_one({"_id": ObjectId(request.order_id)})
+            order = await orders_collection.find_one({"_id": ObjectId(request.order_id)}, ORDER_PROJECTION)
             
             if order:
-                logger.info(colored(f"Order found: {order['_id']}", "green"))
-                return OrderResponse(
-                    order_id=str(order['_id']),
-                    user_id=order['user_id'],
-                    items=[OrderItem(
-                        product_id=item['product_id'],
-                        quantity=item['quantity'],
-                        price=item['price']
-                    ) for item in order['items']],
-                    status=order['status'],
-                    total_amount=order['total_amount'],
-                    created_at=order['created_at']
-                )
+                logger.info("Order found: %s", order['_id'])
+                return order_response(order)
             else:
-                logger.warning(colored(f"Order not found with ID: {request.order_id}", "yellow"))
+                logger.warning("Order not found with ID: %s", request.order_id)
                 context.set_code(grpc.StatusCode.NOT_FOUND)
                 context.set_details('Order not found')
                 return OrderResponse()
         except Exception as e:
-            logger.error(colored(f"Error getting order: {str(e)}", "red"))
+            logger.error("Error getting order: %s", e)
             context.set_code(grpc.StatusCode.INTERNAL)
             context.set_details('Internal error occurred')
             return OrderResponse()
 
     async def UpdateOrderStatus(self, request, context):
         try:
-            logger.info(colored(f"Updating order status: {request.order_id} to {request.status}", "cyan"))
-            
-            from bson import ObjectId
-            result = await orders_collection.update_one(
-                {"_id": ObjectId(request.order_id)},
-                {"$set": {"status": request.status}}
-            )
+            logger.info("Updating order status: %s to %s", request.order_id, request.status)
             
-            if result.modified_count == 0:
-                logger.warning(colored(f"Order not found with ID: {request.order_id}", "yellow"))
-                context.set_code(grpc.StatusCode.NOT_FOUND)
-                context.set_details('Order not found')
+            if request.status not in ORDER_STATUSES:
+                logger.warning("Unknown order status: %s", request.status)
+                context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+                context.set_details('Unknown order status')
                 return OrderResponse()
             
-            order = await orders_collection.find_one({"_id": ObjectId(request.order_id)})
+            order_id = ObjectId(request.order_id)
+            order = await self._transition(order_id, request.status)
             
-            logger.info(colored(f"Order status updated successfully: {request.order_id}", "green"))
+            if order is None:
+                current = await orders_collection.find_one({"_id": order_id}, STATUS_PROJECTION)
+                if current is None:
+                    logger.warning("Order not found with ID: %s", request.order_id)
+                    context.set_code(grpc.StatusCode.NOT_FOUND)
+                    context.set_details('Order not found')
+                else:
+                    current_status = order_status(current)
+                    logger.warning("Rejected transition %s -> %s for order: %s", current_status, request.status, request.order_id)
+                    context.set_code(grpc.StatusCode.FAILED_PRECONDITION)
+                    context.set_details(f"Cannot change status from {current_status} to {request.status}")
+                return OrderResponse()
             
-            return OrderResponse(
-                order_id=str(order['_id']),
-                user_id=order['user_id'],
-                items=[OrderItem(
-                    product_id=item['product_id'],
-                    quantity=item['quantity'],
-                    price=item['price']
-                ) for item in order['items']],
-                status=order['status'],
-                total_amount=order['total_amount'],
-                created_at=order['created_at']
-            )
+            self.changes.publish(request.order_id, request.status)
+            if request.status == 'CANCELLED':
+                await user_stats.record_cancelled([order])
+            logger.info("Order status updated successfully: %s", request.order_id)
+            
+            return order_response(order)
         except Exception as e:
-            logger.error(colored(f"Error updating order status: {str(e)}", "red"))
+            logger.error("Error updating order status: %s", e)
             context.set_code(grpc.StatusCode.INTERNAL)
             context.set_details('Internal error occurred')
             return OrderResponse()
 
+    async def BulkUpdateOrderStatus(self, request, context):
+        try:
+            logger.info("Applying %s status updates", len(request.updates))
+
+            rejected = []
+            operations = []
+            # every status requested per order, in request order
+            targets = {}
+            expected = 0
+            # marks the orders this request cancels, since a rejected cancellation of an
+            # already cancelled order is indistinguishable from an applied one below
+            batch_id = ObjectId()
+            for update in request.updates:
+                if update.status not in ORDER_STATUSES or not ObjectId.is_valid(update.order_id):
+                    rejected.append(update.order_id)
+                    continue
+                order_id = ObjectId(update.order_id)
+                change = {STATUS: update.status}
+                if update.status == 'CANCELLED':
+                    change[CANCELLED_IN] = batch_id
+                query = transition_filter(order_id, update.status)
+                operations.append(UpdateOne(query, {"$set": change}))
+                if ORDER_LEGACY_READS:
+                    # an order is in one format or the other, so at most one of the pair applies
+                    operations.append(UpdateOne(legacy_query(query), {"$set": legacy_query(change)}))
+                targets.setdefault(order_id, []).append(update.status)
+                expected += 1
+
+            modified = 0
+            if operations:
+                # ordered, so several transitions of one order in a batch apply in sequence
+                result = await orders_collection.bulk_write(operations, ordered=True)
+                modified = result.modified_count
+                final = {order_id: statuses[-1] for order_id, statuses in targets.items()}
+                if modified < expected:
+                    # an order counts as updated if any of its transitions applied; it ends in that status
+                    final = {}
+                    async for order in orders_collection.find({"_id": {"$in": list(targets)}}, STATUS_PROJECTION):
+                        if order_status(order) in targets[order["_id"]]:
+                            final[order["_id"]] = order_status(order)
+                    rejected.extend(str(order_id) for order_id in targets if order_id not in final)
+                for order_id, status in final.items():
+                    self.changes.publish(str(order_id), status)
+                if any('CANCELLED' in statuses for statuses in targets.values()):
+                    # by the marker, so an order cancelled here and then refused a later transition still counts
+                    await user_stats.record_cancelled(await orders_collection.find(
+                        {"_id": {"$in": list(targets)}, CANCELLED_IN: batch_id}, SUMMARY_PROJECTION
+                    ).to_list(None))
+
+            logger.info("Bulk status update: %s modified, %s rejected", modified, len(rejected))
+            return BulkUpdateOrderStatusResponse(modified=modified, rejected_order_ids=rejected)
+        except Exception as e:
+            logger.error("Error applying bulk status update: %s", e)
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details('Internal error occurred')
+            return BulkUpdateOrderStatusResponse()
+
+    async def CreateOrders(self, request_iterator, context):
+        results = []
+        try:
+            batch = []
+            async for request in request_iterator:
+                batch.append(build_order_doc(request))
+                if len(batch) >= CREATE_ORDERS_BATCH_SIZE:
+                    results.extend(await self._insert_batch(batch))
+                    batch = []
+            if batch:
+                results.extend(await self._insert_batch(batch))
+
+            failed = sum(1 for result in results if not result.success)
+            logger.info("Created %s orders in batch, %s failed", len(results) - failed, failed)
+            return CreateOrdersResponse(results=results)
+        except Exception as e:
+            logger.error("Error creating orders: %s", e)
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details('Internal error occurred')
+            return CreateOrdersResponse(results=results)
+
+    async def _insert_batch(self, docs):
+        errors = {}
+        try:
+            await orders_collection.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                errors[error['index']] = error.get('errmsg', 'Write failed')
+
+        for index, doc in enumerate(docs):
+            if index not in errors:
+                self.changes.publish(str(doc['_id']), doc[STATUS])
+        await user_stats.record_created([doc for index, doc in enumerate(docs) if index not in errors])
+
+        return [
+            CreateOrderResult(success=False, error=errors[index])
+            if index in errors else
+            CreateOrderResult(success=True, order=order_response(doc))
+            for index, doc in enumerate(docs)
+        ]
+
+    async def ListOrders(self, request, context):
+        try:
+            logger.info("Listing orders for user: %s", request.user_id)
+
+            page_size = request.page_size or LIST_ORDERS_DEFAULT_PAGE_SIZE
+            page_size = max(1, min(page_size, LIST_ORDERS_MAX_PAGE_SIZE))
+
+            query = {USER_ID: request.user_id}
+            if request.status:
+                query[STATUS] = request.status
+            if request.cursor:
+                try:
+                    created_at, last_id = decode_cursor(request.cursor)
+                except Exception:
+                    context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+                    context.set_details('Invalid cursor')
+                    return ListOrdersResponse()
+                query["$or"] = [
+                    {CREATED_AT: {"$lt": created_at}},
+                    {CREATED_AT: created_at, "_id": {"$lt": last_id}}
+                ]
+
+            pages = [orders_collection.find(query, ORDER_PROJECTION).sort(
+                [(CREATED_AT, DESCENDING), ("_id", DESCENDING)]
+            ).limit(page_size + 1).to_list(length=page_size + 1)]
+            if ORDER_LEGACY_READS:
+                pages.append(orders_collection.find(legacy_query(query), ORDER_PROJECTION).sort(
+                    [(LEGACY_FIELDS[CREATED_AT], DESCENDING), ("_id", DESCENDING)]
+                ).limit(page_size + 1).to_list(length=page_size + 1))
+            pages = await asyncio.gather(*pages)
+            orders = pages[0]
+            if len(pages) > 1 and pages[1]:
+                orders = sorted(orders + pages[1], key=order_sort_key, reverse=True)[:page_size + 1]
+
+            next_cursor = ""
+            if len(orders) > page_size:
+                orders = orders[:page_size]
+                next_cursor = encode_cursor(orders[-1])
+
+            logger.info("Found %s orders for user: %s", len(orders), request.user_id)
+            return ListOrdersResponse(
+                orders=[order_response(order) for order in orders],
+                next_cursor=next_cursor
+            )
+        except Exception as e:
+            logger.error("Error listing orders: %s", e)
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details('Internal error occurred')
+            return ListOrdersResponse()
+
+    async def ExportOrders(self, request, context):
+        logger.info("Exporting orders from %s to %s", request.from_date or '-', request.to_date or '-')
+
+        query = {}
+        created_at = {}
+        try:
+            if request.from_date:
+                created_at["$gte"] = datetime.fromisoformat(request.from_date)
+            if request.to_date:
+                created_at["$lt"] = datetime.fromisoformat(request.to_date)
+        except ValueError:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details('Dates must be in ISO format')
+            return
+        # without a date range this still tells the two formats apart, so no order is exported twice
+        query[CREATED_AT] = created_at or {"$exists": True}
+        if request.status:
+            query[STATUS] = request.status
+
+        cursors = [orders_collection.find(query, ORDER_PROJECTION).sort(
+            [(CREATED_AT, ASCENDING), ("_id", ASCENDING)]
+        ).batch_size(EXPORT_BATCH_SIZE)]
+        if ORDER_LEGACY_READS:
+            cursors.append(orders_collection.find(legacy_query(query), ORDER_PROJECTION).sort(
+                [(LEGACY_FIELDS[CREATED_AT], ASCENDING), ("_id", ASCENDING)]
+            ).batch_size(EXPORT_BATCH_SIZE))
+        orders = cursors[0] if len(cursors) == 1 else merge_sorted(cursors, order_sort_key)
+        exported = 0
+        try:
+            async for order in orders:
+                # yielding waits for the transport, so a slow reader slows the cursor down
+                yield order_response(order)
+                exported += 1
+            logger.info("Exported %s orders", exported)
+        except asyncio.CancelledError:
+            logger.warning("Order export cancelled by client after %s orders", exported)
+            raise
+        except Exception as e:
+            logger.error("Error exporting orders: %s", e)
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details('Internal error occurred')
+        finally:
+            for cursor in cursors:
+                await cursor.close()
+
+    async def WatchOrderChanges(self, request, context):
+        if not self.serve_changes:
+            context.set_code(grpc.StatusCode.FAILED_PRECONDITION)
+            context.set_details('Order changes are not published with several worker processes')
+            return
+        logger.info("Order change subscriber connected")
+        queue = self.changes.subscribe()
+        try:
+            await context.send_initial_metadata(())
+            while True:
+                change = await queue.get()
+                if change is None:
+                    logger.warning("Dropping order change subscriber that fell behind")
+                    context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+                    context.set_details('Subscriber fell behind')
+                    return
+                order_id, status = change
+                yield OrderChange(order_id=order_id, status=status)
+        finally:
+            self.changes.unsubscribe(queue)
+            logger.info("Order change subscriber disconnected")
+
+    async def GetUserStats(self, request, context):
+        try:
+            logger.info("Getting stats for user: %s", request.user_id)
+
+            days = await user_stats.get(request.user_id, request.from_date, request.to_date)
+            days = [day for day in days if day['order_count']]
+
+            return UserStatsResponse(
+                user_id=request.user_id,
+                order_count=sum(day['order_count'] for day in days),
+                total_amount=sum(day['total_cents'] for day in days) / 100,
+                days=[DailyUserStats(
+                    date=day['day'],
+                    order_count=day['order_count'],
+                    total_amount=day['total_cents'] / 100
+                ) for day in days]
+            )
+        except Exception as e:
+            logger.error("Error getting user stats: %s", e)
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details('Internal error occurred')
+            return UserStatsResponse()
+
+def warm_up_steps():
+    return [('mongodb', functools.partial(ping_mongodb, client)), ('indexes', ensure_indexes)]
+
 async def serve():
-    server = grpc.aio.server(futures.ThreadPoolExecutor(max_workers=10))
-    order_pb2_grpc.add_OrderServiceServicer_to_server(OrderService(), server)
+    server = grpc.aio.server(
+        futures.ThreadPoolExecutor(max_workers=10),
+        interceptors=[
+            logs.RequestIdInterceptor(),
+            metrics.ServerMetricsInterceptor(),
+            ConcurrencyLimitInterceptor(),
+        ],
+        options=supervisor.SERVER_OPTIONS
+    )
+    # the change feed only sees this process's writes, so it is not served next to other workers
+    servicer = OrderService(serve_changes=supervisor.SERVER_WORKERS <= 1)
+    order_pb2_grpc.add_OrderServiceServicer_to_server(servicer, server)
+    readiness = Readiness(server, [order_pb2.DESCRIPTOR.services_by_name['OrderService'].full_name])
+    await readiness.start(warm_up_steps())
     listen_addr = '[::]:50052'
     server.add_insecure_port(listen_addr)
-    logger.info(colored(f"Starting server on {listen_addr}", "green"))
+    logger.info("Starting server on %s", listen_addr)
     await server.start()
-    await server.wait_for_termination()
+    await metrics.start_http_server(supervisor.worker_port(metrics.METRICS_PORT))
+    try:
+        await supervisor.wait_for_shutdown(server, before_stop=readiness.stop)
+    finally:
+        if servicer.coalescer:
+            await servicer.coalescer.close()
 
 if __name__ == '__main__':
-    logger.info(colored("Order service starting...", "green"))
-    asyncio.run(serve())
\ No newline at end of file
+    logger.info("Order service starting...")
+    supervisor.run(serve)
\ No newline at end of file
@@ -0,0 +1,22 @@
+from order_pb2 import OrderStatus
+from order_schema import STATUS
+
+ORDER_STATUSES = frozenset(OrderStatus.keys())
+
+TRANSITIONS = {
+    "PENDING": {"CONFIRMED", "CANCELLED"},
+    "CONFIRMED": {"SHIPPED", "CANCELLED"},
+    "SHIPPED": {"DELIVERED"},
+    "DELIVERED": set(),
+    "CANCELLED": set(),
+}
+
+# target status -> statuses an order may be in to move there
+ALLOWED_SOURCES = {
+    status: sorted(source for source, targets in TRANSITIONS.items() if status in targets)
+    for status in ORDER_STATUSES
+}
+
+
+def transition_filter(order_id, status):
+    return {"_id": order_id, STATUS: {"$in": ALLOWED_SOURCES[status]}}
@@ -0,0 +1,31 @@
+"""Recomputes the user_order_stats rollups from the orders collection.
+
+    python rebuild_user_stats.py --from-date 2024-01-01 --to-date 2024-02-01
+
+Without dates the whole order history is rebuilt.
+"""
+import asyncio
+import argparse
+
+import order_service
+from user_stats import REBUILD_CHUNK_DAYS, REBUILD_PARALLELISM
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--from-date', default='')
+    parser.add_argument('--to-date', default='')
+    parser.add_argument('--chunk-days', type=int, default=REBUILD_CHUNK_DAYS)
+    parser.add_argument('--parallelism', type=int, default=REBUILD_PARALLELISM)
+    args = parser.parse_args()
+
+    await order_service.user_stats.ensure_indexes()
+    written = await order_service.user_stats.rebuild(
+        order_service.orders_collection, args.from_date, args.to_date,
+        chunk_days=args.chunk_days, parallelism=args.parallelism
+    )
+    print({'rollups': written})
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,182 @@
+import os
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, ReplaceOne, UpdateOne
+from order_schema import (
+    ORDER_LEGACY_READS, LEGACY_FIELDS, USER_ID, STATUS, TOTAL, CREATED_AT, order_summary, legacy_query, to_cents
+)
+
+REBUILD_CHUNK_DAYS = int(os.getenv('USER_STATS_REBUILD_CHUNK_DAYS', '7'))
+REBUILD_PARALLELISM = int(os.getenv('USER_STATS_REBUILD_PARALLELISM', '4'))
+REBUILD_WRITE_BATCH = 1000
+
+logger = logging.getLogger(os.getenv('SERVICE_NAME', 'ORDER_SERVICE'))
+
+
+class UserStats:
+    """Per-user, per-day order count and spend in cents, kept up to date with $inc upserts.
+
+    An order counts towards the day it was created on, and cancelling it
+    takes it back out of that day. The updates follow the order writes
+    instead of sharing a transaction with them, so a failure in between
+    leaves a rollup off by that order until `rebuild` is run.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def ensure_indexes(self):
+        await self.collection.create_index(
+            [("user_id", ASCENDING), ("day", ASCENDING)], name="user_day"
+        )
+
+    async def record_created(self, orders):
+        await self._apply(orders, 1)
+
+    async def record_cancelled(self, orders):
+        await self._apply(orders, -1)
+
+    async def _apply(self, orders, sign):
+        deltas = defaultdict(lambda: [0, 0])
+        for order in orders:
+            user_id, day, cents = order_summary(order)
+            delta = deltas[(user_id, day)]
+            delta[0] += sign
+            delta[1] += sign * cents
+        if not deltas:
+            return
+        operations = [
+            UpdateOne(
+                {"_id": f"{user_id}:{day}"},
+                {"$setOnInsert": {"user_id": user_id, "day": day},
+                 "$inc": {"order_count": count, "total_cents": cents}},
+                upsert=True
+            )
+            for (user_id, day), (count, cents) in deltas.items()
+        ]
+        try:
+            await self.collection.bulk_write(operations, ordered=False)
+        except Exception as e:
+            # the orders themselves are already written; the next rebuild repairs the rollup
+            logger.error("Error updating user stats for %s orders: %s", len(orders), e)
+
+    async def get(self, user_id, from_date="", to_date=""):
+        query = {"user_id": user_id}
+        day = {}
+        if from_date:
+            day["$gte"] = from_date[:10]
+        if to_date:
+            day["$lt"] = to_date[:10]
+        if day:
+            query["day"] = day
+        return await self.collection.find(query).sort("day", ASCENDING).to_list(None)
+
+    async def rebuild(self, orders, from_date="", to_date="", chunk_days=REBUILD_CHUNK_DAYS,
+                      parallelism=REBUILD_PARALLELISM):
+        """Recomputes the rollups of [from_date, to_date) from `orders`.
+
+        The range is split into chunks of `chunk_days` days, aggregated
+        `parallelism` at a time. A chunk owns every rollup of its days, so
+        chunks never touch the same document. Orders written to a day while
+        its chunk is being rebuilt may be missed, so run it while writes are
+        quiet.
+        """
+        first, last = await self._bounds(orders, from_date, to_date)
+        if first is None:
+            return 0
+        run_id = ObjectId()
+        semaphore = asyncio.Semaphore(parallelism)
+
+        async def rebuild_chunk(start, end):
+            async with semaphore:
+                return await self._rebuild_chunk(orders, start, end, run_id)
+
+        chunks = []
+        start = first
+        while start < last:
+            end = min(start + timedelta(days=chunk_days), last)
+            chunks.append(rebuild_chunk(start, end))
+            start = end
+        written = sum(await asyncio.gather(*chunks))
+        logger.info("Rebuilt %s user stats in %s chunks", written, len(chunks))
+        return written
+
+    async def _bounds(self, orders, from_date, to_date):
+        first = date.fromisoformat(from_date[:10]) if from_date else None
+        last = date.fromisoformat(to_date[:10]) if to_date else None
+        if first is None or last is None:
+            days = await self._order_days(orders)
+            if not days:
+                return None, None
+            first = first or min(days)
+            last = last or max(days) + timedelta(days=1)
+        return first, last
+
+    async def _order_days(self, orders):
+        """Days of the oldest and the newest order in each stored format."""
+        fields = [CREATED_AT]
+        if ORDER_LEGACY_READS:
+            fields.append(LEGACY_FIELDS[CREATED_AT])
+        days = []
+        for field in fields:
+            for direction in (ASCENDING, DESCENDING):
+                found = await orders.find({field: {"$exists": True}}, {field: 1}) \
+                    .sort(field, direction).limit(1).to_list(1)
+                if found:
+                    created_at = found[0][field]
+                    if isinstance(created_at, str):
+                        created_at = datetime.fromisoformat(created_at)
+                    days.append(created_at.date())
+        return days
+
+    async def _rebuild_chunk(self, orders, start, end, run_id):
+        query = {
+            CREATED_AT: {"$gte": datetime.combine(start, datetime.min.time()),
+                         "$lt": datetime.combine(end, datetime.min.time())},
+            STATUS: {"$ne": "CANCELLED"}
+        }
+        if ORDER_LEGACY_READS:
+            query = {"$or": [query, legacy_query(query)]}
+        legacy = {field: f"${name}" for field, name in LEGACY_FIELDS.items()}
+        pipeline = [
+            {"$match": query},
+            {"$group": {
+                "_id": {
+                    "user_id": {"$ifNull": [f"${USER_ID}", legacy[USER_ID]]},
+                    "day": {"$ifNull": [
+                        {"$dateToString": {"format": "%Y-%m-%d", "date": f"${CREATED_AT}"}},
+                        {"$substr": [legacy[CREATED_AT], 0, 10]}
+                    ]}
+                },
+                "order_count": {"$sum": 1},
+                "total_cents": {"$sum": f"${TOTAL}"},
+                # legacy totals are float amounts, converted once per group below
+                "legacy_amount": {"$sum": legacy[TOTAL]}
+            }}
+        ]
+        written = 0
+        operations = []
+        async for group in orders.aggregate(pipeline, allowDiskUse=True):
+            user_id, day = group["_id"]["user_id"], group["_id"]["day"]
+            operations.append(ReplaceOne({"_id": f"{user_id}:{day}"}, {
+                "user_id": user_id,
+                "day": day,
+                "order_count": group["order_count"],
+                "total_cents": group["total_cents"] + to_cents(group["legacy_amount"]),
+                "rebuild_id": run_id
+            }, upsert=True))
+            if len(operations) >= REBUILD_WRITE_BATCH:
+                await self.collection.bulk_write(operations, ordered=False)
+                written += len(operations)
+                operations = []
+        if operations:
+            await self.collection.bulk_write(operations, ordered=False)
+            written += len(operations)
+        # days whose orders were all cancelled or removed since the last rollup
+        await self.collection.delete_many(
+            {"day": {"$gte": start.isoformat(), "$lt": end.isoformat()}, "rebuild_id": {"$ne": run_id}}
+        )
+        return written
@@ -0,0 +1,77 @@
+import asyncio
+from pymongo.errors import BulkWriteError, WriteError
+
+
+class WriteCoalescer:
+    """Gathers concurrent inserts into one unordered insert_many.
+
+    A batch is flushed once it holds `max_batch` documents or `max_delay_ms`
+    after its first document arrived, whichever comes first. Every caller
+    gets its own inserted id or its own write error back. `after_write`, if
+    given, is awaited once per batch with the documents that were inserted,
+    before any caller is released.
+    """
+
+    def __init__(self, collection, max_batch=100, max_delay_ms=5, after_write=None):
+        self.collection = collection
+        self.after_write = after_write
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self._pending = []
+        self._timer = None
+        self._flushes = set()
+
+    async def insert(self, doc):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((doc, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_delay, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = asyncio.ensure_future(self._write(batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _write(self, batch):
+        docs = [doc for doc, _ in batch]
+        failed = {}
+        try:
+            await self.collection.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                failed[error['index']] = WriteError(error.get('errmsg'), error.get('code'), error)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        try:
+            written = [doc for index, doc in enumerate(docs) if index not in failed]
+            if self.after_write is not None and written:
+                await self.after_write(written)
+        finally:
+            self._resolve(batch, failed)
+
+    def _resolve(self, batch, failed):
+        for index, (doc, future) in enumerate(batch):
+            if future.done():
+                continue
+            if index in failed:
+                future.set_exception(failed[index])
+            else:
+                future.set_result(doc['_id'])
+
+    async def close(self):
+        self._flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
@@ -0,0 +1,53 @@
+import os
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from passlib.context import CryptContext
+
+HASH_WORKERS = int(os.getenv('HASH_WORKERS', str(os.cpu_count() or 1)))
+HASH_MAX_PENDING = int(os.getenv('HASH_MAX_PENDING', str(HASH_WORKERS * 4)))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+def _hash(password):
+    return pwd_context.hash(password)
+
+
+def _verify(password, hashed_password):
+    return pwd_context.verify(password, hashed_password)
+
+
+class HashingBusy(Exception):
+    pass
+
+
+class HashingEngine:
+    def __init__(self, max_workers=HASH_WORKERS, max_pending=HASH_MAX_PENDING):
+        # spawn keeps the workers free of the parent's gRPC/asyncio state
+        self._executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.pending = 0
+
+    async def _submit(self, fn, *args):
+        if self.pending >= self.max_pending:
+            raise HashingBusy(f"{self.pending} hashing jobs pending")
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, fn, *args)
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password):
+        return await self._submit(_hash, password)
+
+    async def verify(self, password, hashed_password):
+        return await self._submit(_verify, password, hashed_password)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
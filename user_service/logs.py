@@ -0,0 +1,192 @@
+import os
+import sys
+import json
+import uuid
+import queue
+import atexit
+import random
+import logging
+import contextvars
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+import grpc
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'auto')
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+LOG_SAMPLE_DEFAULT = float(os.getenv('LOG_SAMPLE_DEFAULT', '1.0'))
+# JSON object of message template -> rate, e.g. {"Getting order with ID: %s": 0.01}
+LOG_SAMPLE_RATES = json.loads(os.getenv('LOG_SAMPLE_RATES', '{}'))
+
+REQUEST_ID_HEADER = 'x-request-id'
+
+request_id_var = contextvars.ContextVar('request_id', default=None)
+
+_RECORD_ATTRS = frozenset(logging.makeLogRecord({}).__dict__) | {'message', 'asctime', 'request_id'}
+
+_COLORS = {
+    logging.DEBUG: '\033[90m',
+    logging.INFO: '\033[36m',
+    logging.WARNING: '\033[33m',
+    logging.ERROR: '\033[31m',
+    logging.CRITICAL: '\033[1;31m',
+}
+_RESET = '\033[0m'
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:16]
+
+
+def request_metadata():
+    """Outgoing gRPC metadata carrying the current request id, if any."""
+    request_id = request_id_var.get()
+    if request_id is None:
+        return None
+    return ((REQUEST_ID_HEADER, request_id),)
+
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self, service):
+        super().__init__()
+        self.service = service
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'service': self.service,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.request_id:
+            entry['request_id'] = record.request_id
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self, colors):
+        super().__init__('%(asctime)s %(levelname)s %(name)s %(request_tag)s%(message)s')
+        self.colors = colors
+
+    def format(self, record):
+        record.request_tag = f'[{record.request_id}] ' if record.request_id else ''
+        line = super().format(record)
+        if self.colors:
+            return f'{_COLORS.get(record.levelno, "")}{line}{_RESET}'
+        return line
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a configured fraction of records per message template.
+
+    Warnings and errors are never sampled out.
+    """
+
+    def __init__(self, rates=None, default=LOG_SAMPLE_DEFAULT):
+        super().__init__()
+        self.rates = LOG_SAMPLE_RATES if rates is None else rates
+        self.default = default
+        self._random = random.random
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(record.msg, self.default)
+        return rate >= 1.0 or self._random() < rate
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Hands records to the listener thread without formatting them here.
+
+    When the queue is full the record is dropped instead of blocking the
+    event loop; drops are counted in `dropped`.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # the request id lives in a contextvar, so it must be captured on the calling side
+        record.request_id = request_id_var.get()
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener = None
+_settings = None
+
+
+def _stop_listener():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def setup_logging(service, level=LOG_LEVEL, log_format=LOG_FORMAT, stream=None):
+    global _listener, _settings
+    _settings = (service, level, log_format, stream)
+    stream = stream or sys.stderr
+    if log_format == 'auto':
+        log_format = 'text' if stream.isatty() else 'json'
+
+    output = logging.StreamHandler(stream)
+    if log_format == 'json':
+        output.setFormatter(JsonFormatter(service))
+    else:
+        output.setFormatter(TextFormatter(colors=stream.isatty()))
+
+    handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    _stop_listener()
+    _listener = QueueListener(handler.queue, output, respect_handler_level=True)
+    _listener.start()
+    return logging.getLogger(service)
+
+
+def _restart_after_fork():
+    # the listener thread does not survive fork, so a forked worker gets a queue and listener of its own
+    global _listener
+    _listener = None
+    if _settings is not None:
+        setup_logging(*_settings)
+
+
+atexit.register(_stop_listener)
+os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+class RequestIdInterceptor(grpc.aio.ServerInterceptor):
+    """grpc.aio server interceptor that binds the caller's x-request-id (or a new one).
+
+    The handler runs in the same task as the interceptor chain, so the
+    contextvar set here is visible to every log call of the RPC.
+    """
+
+    async def intercept_service(self, continuation, handler_call_details):
+        request_id = None
+        for key, value in handler_call_details.invocation_metadata or ():
+            if key == REQUEST_ID_HEADER:
+                request_id = value
+                break
+        request_id_var.set(request_id or new_request_id())
+        return await continuation(handler_call_details)
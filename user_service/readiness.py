@@ -0,0 +1,87 @@
+"""grpc.health.v1 for the gRPC services, SERVING only once the process is warmed up.
+
+Also a probe for container health checks, exiting 0 only when the server
+on the given local port reports SERVING:
+    python readiness.py 50051
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import grpc
+from grpc_health.v1 import health, health_pb2, health_pb2_grpc
+
+WARMUP_STEP_TIMEOUT = float(os.getenv('WARMUP_STEP_TIMEOUT', '5'))
+WARMUP_MAX_BACKOFF = float(os.getenv('WARMUP_MAX_BACKOFF', '5'))
+
+SERVING = health_pb2.HealthCheckResponse.SERVING
+NOT_SERVING = health_pb2.HealthCheckResponse.NOT_SERVING
+
+logger = logging.getLogger(os.getenv('SERVICE_NAME', __name__))
+
+
+async def ping_mongodb(client):
+    # Motor connects lazily; this makes it select a server and open a pooled connection
+    await client.admin.command('ping')
+
+
+class Readiness:
+    """Health service that reports NOT_SERVING until every warm-up step has passed.
+
+    Steps are `(name, coroutine function)` pairs run in order; a failing or
+    slow step is retried with backoff instead of crashing the process, so a
+    service started before its database or downstreams simply stays
+    NOT_SERVING for a while. On shutdown everything goes NOT_SERVING for good.
+    """
+
+    def __init__(self, server, services=()):
+        self.servicer = health.aio.HealthServicer()
+        health_pb2_grpc.add_HealthServicer_to_server(self.servicer, server)
+        self.services = ('', *services)
+        self.ready = False
+        self._task = None
+
+    async def _set(self, status):
+        for service in self.services:
+            await self.servicer.set(service, status)
+
+    async def start(self, steps):
+        """Marks the server NOT_SERVING and warms it up in the background; call before server.start()."""
+        await self._set(NOT_SERVING)
+        self._task = asyncio.create_task(self._warm_up(steps))
+
+    async def _warm_up(self, steps):
+        started = time.perf_counter()
+        for name, step in steps:
+            backoff = 0.1
+            while True:
+                try:
+                    await asyncio.wait_for(step(), WARMUP_STEP_TIMEOUT)
+                    break
+                except Exception as e:
+                    logger.warning("Warm-up step %s failed, retrying in %.1fs: %r", name, backoff, e)
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, WARMUP_MAX_BACKOFF)
+        await self._set(SERVING)
+        self.ready = True
+        logger.info("Warmed up in %.3fs, serving", time.perf_counter() - started)
+
+    async def stop(self):
+        self.ready = False
+        if self._task is not None:
+            self._task.cancel()
+        await self.servicer.enter_graceful_shutdown()
+
+
+def probe(port, timeout=2):
+    with grpc.insecure_channel(f'127.0.0.1:{port}') as channel:
+        response = health_pb2_grpc.HealthStub(channel).Check(health_pb2.HealthCheckRequest(), timeout=timeout)
+    return response.status == SERVING
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(0 if probe(int(sys.argv[1])) else 1)
+    except grpc.RpcError:
+        sys.exit(1)
@@ -0,0 +1,124 @@
+import os
+import time
+import atexit
+import signal
+import asyncio
+import logging
+
+SERVER_WORKERS = int(os.getenv('SERVER_WORKERS', '1'))
+SHUTDOWN_GRACE = float(os.getenv('SHUTDOWN_GRACE', '10'))
+WORKER_RESTART_DELAY = float(os.getenv('WORKER_RESTART_DELAY', '1'))
+
+# lets every worker bind the service port; the kernel spreads new connections over them
+SERVER_OPTIONS = [('grpc.so_reuseport', 1)]
+
+logger = logging.getLogger(os.getenv('SERVICE_NAME', __name__))
+
+worker_index = 0
+
+
+def worker_port(port):
+    """`port` offset by the worker index, for listeners each process needs its own of; 0 stays 0."""
+    return port + worker_index if port else port
+
+
+async def wait_for_shutdown(server, grace=SHUTDOWN_GRACE, before_stop=None):
+    """Serves until SIGTERM/SIGINT, then refuses new RPCs and gives running ones `grace` seconds.
+
+    `before_stop`, if given, is awaited first (e.g. to report NOT_SERVING to health checks).
+    """
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+    await stopping.wait()
+    logger.info("Shutting down, draining RPCs for up to %ss", grace)
+    if before_stop is not None:
+        await before_stop()
+    await server.stop(grace)
+
+
+def run(serve, workers=SERVER_WORKERS):
+    """Runs `serve()` in this process, or in `workers` forked processes under a Supervisor."""
+    if workers <= 1:
+        asyncio.run(serve())
+    else:
+        Supervisor(serve, workers).run()
+
+
+class Supervisor:
+    """Forks worker processes that each run `serve()` and restarts the ones that die.
+
+    The supervisor itself opens no sockets, threads or database connections
+    before forking, so every worker builds its own event loop, gRPC server
+    and Motor connection pool. On SIGTERM/SIGINT the signal is passed on to
+    the workers, which drain, and whatever still runs after `grace` seconds
+    is killed.
+    """
+
+    def __init__(self, serve, workers, grace=SHUTDOWN_GRACE, restart_delay=WORKER_RESTART_DELAY):
+        self.serve = serve
+        self.workers = workers
+        self.grace = grace
+        self.restart_delay = restart_delay
+        self.children = {}
+        self.restarts = {}
+        self.kill_at = None
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for index in range(self.workers):
+            self._spawn(index)
+        logger.info("Started %s worker processes", self.workers)
+
+        while self.children or (self.restarts and self.kill_at is None):
+            pid, status = os.waitpid(-1, os.WNOHANG) if self.children else (0, 0)
+            if pid:
+                index = self.children.pop(pid)
+                if self.kill_at is None:
+                    logger.error("Worker %s (pid %s) exited with code %s, restarting",
+                                 index, pid, os.waitstatus_to_exitcode(status))
+                    self.restarts[index] = time.monotonic() + self.restart_delay
+                continue
+
+            now = time.monotonic()
+            if self.kill_at is not None and now >= self.kill_at:
+                for child in self.children:
+                    logger.warning("Killing worker pid %s that did not drain in time", child)
+                    os.kill(child, signal.SIGKILL)
+                self.kill_at = float('inf')
+            for index, due in list(self.restarts.items()):
+                if due <= now and self.kill_at is None:
+                    del self.restarts[index]
+                    self._spawn(index)
+            time.sleep(0.1)
+        logger.info("All worker processes stopped")
+
+    def _stop(self, signum, frame):
+        if self.kill_at is not None:
+            return
+        self.kill_at = time.monotonic() + self.grace + 1
+        for pid in list(self.children):
+            os.kill(pid, signal.SIGTERM)
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = index
+            return
+
+        global worker_index
+        worker_index = index
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            asyncio.run(self.serve())
+        except Exception:
+            logger.exception("Worker %s failed", index)
+            code = 1
+        finally:
+            # run the worker's exit hooks (e.g. flushing logs), but never return into the supervisor loop
+            atexit._run_exitfuncs()
+            os._exit(code)
@@ -1,48 +1,72 @@
 import os
-import asyncio
-import logging
+import time
+import functools
 from concurrent import futures
 import grpc
-from termcolor import colored
 import motor.motor_asyncio
-from passlib.context import CryptContext
 import jwt
+from hashing import HashingEngine, HashingBusy
+import metrics
+from concurrency_limit import ConcurrencyLimitInterceptor
+import logs
+import supervisor
+from readiness import Readiness, ping_mongodb
+import user_pb2
 from user_pb2 import (
     CreateUserRequest,
     UserResponse,
     GetUserRequest,
+    GetUsersRequest,
+    GetUsersResponse,
     AuthRequest,
     AuthResponse
 )
 import user_pb2_grpc
 
-logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'))
-logger = logging.getLogger(os.getenv('SERVICE_NAME', 'USER_SERVICE'))
+logger = logs.setup_logging(os.getenv('SERVICE_NAME', 'USER_SERVICE'))
 
 MONGODB_URI = os.getenv('MONGODB_URI', 'mongodb://localhost:27017')
 MONGODB_DB = os.getenv('MONGODB_DB', 'userdb')
 
 JWT_SECRET_KEY = os.getenv('JWT_SECRET_KEY', 'your-secret-key-keep-it-safe')
+JWT_TTL_SECONDS = int(os.getenv('JWT_TTL_SECONDS', '3600'))
+
+GET_USERS_MAX_IDS = int(os.getenv('GET_USERS_MAX_IDS', '1000'))
+STREAM_USERS_CHUNK = int(os.getenv('STREAM_USERS_CHUNK', '1000'))
+
+USER_PROJECTION = {"username": 1, "email": 1}
 
 client = motor.motor_asyncio.AsyncIOMotorClient(MONGODB_URI)
 db = client[MONGODB_DB]
-users_collection = db.users
+users_collection = metrics.InstrumentedCollection(db.users)
+
+def parse_object_ids(user_ids):
+    from bson import ObjectId
+    return [ObjectId(user_id) for user_id in dict.fromkeys(user_ids) if ObjectId.is_valid(user_id)]
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+def user_response(user):
+    return UserResponse(
+        user_id=str(user['_id']),
+        username=user['username'],
+        email=user['email']
+    )
 
 class UserService(user_pb2_grpc.UserServiceServicer):
+    def __init__(self, hashing):
+        self.hashing = hashing
+
     async def CreateUser(self, request, context):
         try:
-            logger.info(colored(f"Creating user with username: {request.username}", "cyan"))
+            logger.info("Creating user with username: %s", request.username)
             
             existing_user = await users_collection.find_one({"username": request.username})
             if existing_user:
-                logger.error(colored(f"User {request.username} already exists", "red"))
+                logger.error("User %s already exists", request.username)
                 context.set_code(grpc.StatusCode.ALREADY_EXISTS)
                 context.set_details('User already exists')
                 return UserResponse()
 
-            hashed_password = pwd_context.hash(request.password)
+            hashed_password = await self.hashing.hash(request.password)
             
             user_doc = {
                 "username": request.username,
@@ -53,83 +77,152 @@ class UserService(user_pb2_grpc.UserServiceServicer):
             result = await users_collection.insert_one(user_doc)
             user_id = str(result.inserted_id)
             
-            logger.info(colored(f"User created successfully with ID: {user_id}", "green"))
+            logger.info("User created successfully with ID: %s", user_id)
             
             return UserResponse(
                 user_id=user_id,
                 username=request.username,
                 email=request.email
             )
+        except HashingBusy as e:
+            logger.warning("Rejecting user creation, hashing pool saturated: %s", e)
+            context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+            context.set_details('Server is busy, try again later')
+            return UserResponse()
         except Exception as e:
-            logger.error(colored(f"Error creating user: {str(e)}", "red"))
+            logger.error("Error creating user: %s", e)
             context.set_code(grpc.StatusCode.INTERNAL)
             context.set_details('Internal error occurred')
             return UserResponse()
 
     async def GetUser(self, request, context):
         try:
-            logger.info(colored(f"Getting user with ID: {request.user_id}", "cyan"))
+            logger.info("Getting user with ID: %s", request.user_id)
             
             from bson import ObjectId
             user = await users_collection.find_one({"_id": ObjectId(request.user_id)})
             
             if user:
-                logger.info(colored(f"User found: {user['username']}", "green"))
+                logger.info("User found: %s", user['username'])
                 return UserResponse(
                     user_id=str(user['_id']),
                     username=user['username'],
                     email=user['email']
                 )
             else:
-                logger.warning(colored(f"User not found with ID: {request.user_id}", "yellow"))
+                logger.warning("User not found with ID: %s", request.user_id)
                 context.set_code(grpc.StatusCode.NOT_FOUND)
                 context.set_details('User not found')
                 return UserResponse()
         except Exception as e:
-            logger.error(colored(f"Error getting user: {str(e)}", "red"))
+            logger.error("Error getting user: %s", e)
             context.set_code(grpc.StatusCode.INTERNAL)
             context.set_details('Internal error occurred')
             return UserResponse()
 
+    async def GetUsers(self, request, context):
+        try:
+            logger.info("Getting %s users", len(request.user_ids))
+
+            if len(request.user_ids) > GET_USERS_MAX_IDS:
+                context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+                context.set_details(f'At most {GET_USERS_MAX_IDS} ids per call, use StreamUsers for more')
+                return GetUsersResponse()
+
+            object_ids = parse_object_ids(request.user_ids)
+            found = {}
+            async for user in users_collection.find({"_id": {"$in": object_ids}}, USER_PROJECTION):
+                found[str(user['_id'])] = user_response(user)
+
+            users = [found[user_id] for user_id in dict.fromkeys(request.user_ids) if user_id in found]
+            logger.info("Found %s of %s users", len(users), len(request.user_ids))
+            return GetUsersResponse(users=users)
+        except Exception as e:
+            logger.error("Error getting users: %s", e)
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details('Internal error occurred')
+            return GetUsersResponse()
+
+    async def StreamUsers(self, request, context):
+        try:
+            logger.info("Streaming %s users", len(request.user_ids))
+
+            object_ids = parse_object_ids(request.user_ids)
+            for start in range(0, len(object_ids), STREAM_USERS_CHUNK):
+                chunk = object_ids[start:start + STREAM_USERS_CHUNK]
+                async for user in users_collection.find({"_id": {"$in": chunk}}, USER_PROJECTION):
+                    yield user_response(user)
+        except Exception as e:
+            logger.error("Error streaming users: %s", e)
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details('Internal error occurred')
+
     async def AuthenticateUser(self, request, context):
         try:
-            logger.info(colored(f"Authenticating user: {request.username}", "cyan"))
+            logger.info("Authenticating user: %s", request.username)
             
             user = await users_collection.find_one({"username": request.username})
             
-            if not user or not pwd_context.verify(request.password, user['hashed_password']):
-                logger.error(colored("Invalid credentials", "red"))
+            if not user or not await self.hashing.verify(request.password, user['hashed_password']):
+                logger.error("Invalid credentials")
                 context.set_code(grpc.StatusCode.UNAUTHENTICATED)
                 context.set_details('Invalid credentials')
                 return AuthResponse(success=False, token="", error="Invalid credentials")
 
+            issued_at = int(time.time())
             token = jwt.encode(
                 {
                     'user_id': str(user['_id']),
-                    'username': user['username']
+                    'username': user['username'],
+                    'iat': issued_at,
+                    'exp': issued_at + JWT_TTL_SECONDS
                 },
                 JWT_SECRET_KEY,
                 algorithm='HS256'
             )
             
-            logger.info(colored(f"User authenticated successfully: {request.username}", "green"))
+            logger.info("User authenticated successfully: %s", request.username)
             return AuthResponse(success=True, token=token, error="")
             
+        except HashingBusy as e:
+            logger.warning("Rejecting authentication, hashing pool saturated: %s", e)
+            context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+            context.set_details('Server is busy, try again later')
+            return AuthResponse(success=False, token="", error="Server is busy")
         except Exception as e:
-            logger.error(colored(f"Error authenticating user: {str(e)}", "red"))
+            logger.error("Error authenticating user: %s", e)
             context.set_code(grpc.StatusCode.INTERNAL)
             context.set_details('Internal error occurred')
             return AuthResponse(success=False, token="", error=str(e))
 
+def warm_up_steps():
+    return [('mongodb', functools.partial(ping_mongodb, client))]
+
 async def serve():
-    server = grpc.aio.server(futures.ThreadPoolExecutor(max_workers=10))
-    user_pb2_grpc.add_UserServiceServicer_to_server(UserService(), server)
+    server = grpc.aio.server(
+        futures.ThreadPoolExecutor(max_workers=10),
+        interceptors=[
+            logs.RequestIdInterceptor(),
+            metrics.ServerMetricsInterceptor(),
+            ConcurrencyLimitInterceptor(),
+        ],
+        options=supervisor.SERVER_OPTIONS
+    )
+    # built here, after the supervisor forks, so every worker has its own bcrypt pool and queues
+    hashing = HashingEngine()
+    user_pb2_grpc.add_UserServiceServicer_to_server(UserService(hashing), server)
+    readiness = Readiness(server, [user_pb2.DESCRIPTOR.services_by_name['UserService'].full_name])
+    await readiness.start(warm_up_steps())
     listen_addr = '[::]:50051'
     server.add_insecure_port(listen_addr)
-    logger.info(colored(f"Starting server on {listen_addr}", "green"))
+    logger.info("Starting server on %s", listen_addr)
     await server.start()
-    await server.wait_for_termination()
+    await metrics.start_http_server(supervisor.worker_port(metrics.METRICS_PORT))
+    try:
+        await supervisor.wait_for_shutdown(server, before_stop=readiness.stop)
+    finally:
+        hashing.shutdown()
 
 if __name__ == '__main__':
-    logger.info(colored("User service starting...", "green"))
-    asyncio.run(serve())
+    logger.info("User service starting...")
+    supervisor.run(serve)